@@ -3,24 +3,28 @@ An agenda of active/passive items in CKY/Ealery program.
 """
 
 from collections import defaultdict
+import heapq
 
 class Agenda(object):
     
     def __init__(self):
         # we are organising active items in a stack (last in first out)
         self._active = []
-        # an item should never queue twice, thus we will manage a set of items which we have already seen
-        self._seen = set()
+        # an item should never queue twice, thus we will manage the items which we have already seen
+        # for each item we also keep its back-pointers: the positions where the symbol before the dot
+        # started, one for each way we derived the item
+        self._seen = dict()
         # we organise incomplete items by the symbols they wait for at a certain position
         # that is, if the key is a pair (Y, i)
-        # the value is a set of items of the form
-        # [X -> alpha * Y beta, [...i]]
-        self._incomplete = defaultdict(set)  
+        # the value is a list of items of the form
+        # [X -> alpha * Y beta, h, i]
+        # (lists suffice because an item is made passive only once)
+        self._incomplete = defaultdict(list)
         # we organise complete items by their LHS symbol spanning from a certain position
         # if the key is a pair (X, i)
-        # then the value is a set of items of the form
-        # [X -> gamma *, [i ... j]]
-        self._complete = defaultdict(set)
+        # then the value is a list of items of the form
+        # [X -> gamma *, i, j]
+        self._complete = defaultdict(list)
         
     def __len__(self):
         """return the number of active items"""
@@ -28,10 +32,14 @@ class Agenda(object):
         
     def push(self, item):
         """push an item into the queue of active items"""
-        if item not in self._seen:  # if an item has been seen before, we simply ignore it
+        splits = self._seen.get(item, None)
+        if splits is None:
             self._active.append(item)
-            self._seen.add(item)
+            self._seen[item] = () if item.split is None else [item.split]
             return True
+        # if an item has been seen before, we only record the new way of deriving it
+        if item.split is not None and item.split not in splits:
+            splits.append(item.split)
         return False
     
     def pop(self):
@@ -41,21 +49,116 @@ class Agenda(object):
     
     def make_passive(self, item):
         if item.is_complete():  # complete items offer a way to rewrite a certain LHS from a certain position
-            self._complete[(item.lhs, item.start)].add(item)
+            self._complete[(item.lhs, item.start)].append(item)
         else:  # incomplete items are waiting for the completion of the symbol to the right of the dot
-            self._incomplete[(item.next, item.dot)].add(item)
+            self._incomplete[(item.next, item.dot)].append(item)
             
     def waiting(self, symbol, dot):
         """return items waiting for `symbol` spanning from `dot`"""
-        return self._incomplete.get((symbol, dot), set())
+        return self._incomplete.get((symbol, dot), ())
     
     def complete(self, lhs, start):
         """return complete items whose LHS symbol is `lhs` spanning from `start`"""
-        return self._complete.get((lhs, start), set())  
+        return self._complete.get((lhs, start), ())
     
+    def back(self, item):
+        """return the back-pointers of an item (see Item.retreat)"""
+        return self._seen.get(item, [])
+
+    def states(self, item):
+        """
+        Return every sequence of positions with which an item was derived.
+
+        For a complete item [X -> A B *, i, j] this is a list of sequences (i, k, j), one for
+        each k where A ends and B starts.
+        """
+        if item.pos == 0:
+            return [(item.start,)]
+        sequences = []
+        for split in self.back(item):
+            for states in self.states(item.retreat(split)):
+                sequences.append(states + (item.dot,))
+        return sequences
+
     def itercomplete(self):
         """an iterator over complete items in arbitrary order"""
         for items in self._complete.itervalues():
             for item in items:
                 yield item
                 
+
+
+class PriorityAgenda(object):
+    """
+    An agenda that pops the active item with the highest priority (Knuth, 1977).
+
+    Each item has a score (e.g. the probability of its best derivation so far) and a single
+    back-pointer, that of its best score. An item may be pushed again with a better score
+    while it is active, but once popped its score is final: if every inference multiplies
+    scores by numbers no larger than one (as probabilities do) and priorities are scores times
+    a consistent heuristic (see viterbi.best_first), no later derivation can beat it.
+
+    Items are whatever hashable and orderable keys the parser uses (viterbi.best_first uses
+    tuples of integers, which hash and compare without calling back into Python), and the
+    parser indexes the items it pops itself. A best-first parser tries many more derivations
+    than it queues, thus `push` rejects a derivation with a single lookup, and only computes
+    the priority of a derivation it queues.
+    """
+
+    def __init__(self):
+        self._heap = []  # (-priority, item), with stale entries left behind
+        self._pushes = 0
+        self._scores = dict()
+        self._best_back = dict()
+        self._popped = set()
+
+    def __len__(self):
+        """return the number of active items"""
+        self._discard_stale()
+        return len(self._heap)
+
+    def _discard_stale(self):
+        # an entry is stale if the item was popped already (with a better priority)
+        while self._heap and self._heap[0][1] in self._popped:
+            heapq.heappop(self._heap)
+
+    def push(self, item, score=1.0, back=None, heuristic=None):
+        """
+        Push an item, unless we already know a derivation at least as good.
+
+        :param item: a key (hashable, and orderable to break ties)
+        :param score: the score of this derivation of the item
+        :param back: a back-pointer (whatever the parser needs to recover this derivation)
+        :param heuristic: a function of the item, called only if the item is queued:
+            the priority is the score times heuristic(item) (by default the score)
+        :returns: whether the item was (re)queued
+        """
+        old = self._scores.get(item, None)
+        # the score of a popped item is final, thus only an active item may improve
+        if old is not None and (old >= score or item in self._popped):
+            return False
+        self._scores[item] = score
+        self._best_back[item] = back
+        self._pushes += 1
+        heapq.heappush(self._heap, (-score if heuristic is None else -score * heuristic(item), item))
+        return True
+
+    def pop(self):
+        """pop the active item with the highest priority"""
+        self._discard_stale()
+        assert len(self._heap) > 0, 'I have no items left.'
+        item = heapq.heappop(self._heap)[1]
+        self._popped.add(item)
+        return item
+
+    def score(self, item):
+        """the best score of an item"""
+        return self._scores[item]
+
+    def best_back(self, item):
+        """the back-pointer of the best score of an item"""
+        return self._best_back[item]
+
+    def num_pushes(self):
+        """how many times items were queued (counting requeued items)"""
+        return self._pushes
@@ -0,0 +1,292 @@
+"""
+Time and memory of the CKY/Earley agendas.
+
+Run with `python benchmark.py`. For each grammar and sentence length we report
+how many items the agenda saw, how long parsing took, and roughly how many bytes
+the agenda spends in all and per item (items, their back-pointers and the agenda's own
+containers; rules are shared with the grammar and are not counted). For CKY we also report
+how many axioms the lexical index avoided (see parser.cky_axioms).
+
+Each parser runs twice: with the current Rule/Item/Agenda ('new') and with a copy of the
+ones they replaced ('old', below), where a Rule has a __dict__ and hashes its probability,
+and an Item keeps the full tuple of its dots, thus an item derived with different split
+points is stored once per split. Both run the same deductions (the same axioms, predictions
+and forests), thus the difference is that of the representation alone.
+"""
+import sys
+import time
+from collections import defaultdict
+from cfg import WCFG, read_grammar_rules
+from rule import Rule
+from agenda import Agenda
+from forest import Forest
+from parser import cky, scan, complete, intern_sentence
+from earley import earley
+
+
+class OldRule(object):
+    """Rule as it was: a __dict__ per rule, and a hash of (lhs, rhs, prob) on every call."""
+
+    def __init__(self, lhs, rhs, prob):
+        self.lhs_ = lhs
+        self.rhs_ = tuple(rhs)
+        self.prob_ = prob
+
+    def __eq__(self, other):
+        return self.lhs_ == other.lhs_ and self.rhs_ == other.rhs_ and self.prob_ == other.prob_
+
+    def __ne__(self, other):
+        return not (self == other)
+
+    def __hash__(self):
+        return hash((self.lhs_, self.rhs_, self.prob_))
+
+    @property
+    def lhs(self):
+        return self.lhs_
+
+    @property
+    def rhs(self):
+        return self.rhs_
+
+    @property
+    def prob(self):
+        return self.prob_
+
+
+class OldItem(object):
+    """Item as it was: a rule and the tuple of all its dots [i ... j]."""
+
+    def __init__(self, rule, dots):
+        self.rule_ = rule
+        self.dots_ = tuple(dots)
+
+    def __eq__(self, other):
+        return self.rule_ == other.rule_ and self.dots_ == other.dots_
+
+    def __ne__(self, other):
+        return not(self == other)
+
+    def __hash__(self):
+        return hash((self.rule_, self.dots_))
+
+    @property
+    def lhs(self):
+        return self.rule_.lhs
+
+    @property
+    def rule(self):
+        return self.rule_
+
+    @property
+    def dot(self):
+        return self.dots_[-1]
+
+    @property
+    def start(self):
+        return self.dots_[0]
+
+    @property
+    def next(self):
+        if self.is_complete():
+            return None
+        return self.rule_.rhs[len(self.dots_) - 1]
+
+    def state(self, i):
+        return self.dots_[i]
+
+    def advance(self, dot):
+        return OldItem(self.rule_, self.dots_ + (dot,))
+
+    def is_complete(self):
+        return len(self.rule_.rhs) + 1 == len(self.dots_)
+
+
+class OldAgenda(object):
+    """Agenda as it was: sets of whole items, with no back-pointers."""
+
+    def __init__(self):
+        self._active = []
+        self._seen = set()
+        self._incomplete = defaultdict(set)
+        self._complete = defaultdict(set)
+
+    def __len__(self):
+        return len(self._active)
+
+    def push(self, item):
+        if item not in self._seen:
+            self._active.append(item)
+            self._seen.add(item)
+            return True
+        return False
+
+    def pop(self):
+        return self._active.pop()
+
+    def make_passive(self, item):
+        if item.is_complete():
+            self._complete[(item.lhs, item.start)].add(item)
+        else:
+            self._incomplete[(item.next, item.dot)].add(item)
+
+    def waiting(self, symbol, dot):
+        return self._incomplete.get((symbol, dot), set())
+
+    def complete(self, lhs, start):
+        return self._complete.get((lhs, start), set())
+
+    def itercomplete(self):
+        for items in self._complete.values():
+            for item in items:
+                yield item
+
+
+class OldGrammar(object):
+    """the indexes of an InternedWCFG that the parsers use, over OldRules (built before we time anything)"""
+
+    def __init__(self, icfg):
+        self.icfg = icfg
+        self.old = dict((rule, OldRule(rule.lhs, rule.rhs, icfg.prob(rule))) for rule in icfg)
+        self.new = dict((old, rule) for rule, old in self.old.items())
+        self._by_lhs = dict((X, [self.old[rule] for rule in icfg.get(X)]) for X in icfg.nonterminals)
+        self._starting_with = dict()
+
+    def get(self, nonterminal):
+        return self._by_lhs.get(nonterminal, ())
+
+    def starting_with(self, word):
+        if word not in self._starting_with:
+            self._starting_with[word] = [self.old[rule] for rule in self.icfg.starting_with(word)]
+        return self._starting_with[word]
+
+
+def old_make_forest(agenda, ocfg):
+    """parser.make_forest as it was: one complete item per sequence of dots"""
+    icfg = ocfg.icfg
+    forest = Forest(icfg.vocab)
+    for item in agenda.itercomplete():
+        lhs = forest.make_node(item.lhs, item.start, item.dot)
+        rhs = [forest.make_node(sym, item.state(i), item.state(i + 1)) for i, sym in enumerate(item.rule.rhs)]
+        rule = ocfg.new[item.rule]
+        forest.add(Rule(lhs, rhs, icfg.prob(rule)), icfg.rule_id(rule))
+    return forest
+
+
+def old_cky(ocfg, sentence, A, stats):
+    """parser.cky with the old representation"""
+    icfg = ocfg.icfg
+    for i, word in enumerate(sentence):
+        for rule in ocfg.starting_with(word):
+            A.push(OldItem(rule, [i]))
+    while A:
+        item = A.pop()
+        if item.is_complete() or icfg.is_nonterminal(item.next):
+            for new in complete(item, A):
+                A.push(new)
+        else:
+            new = scan(item, sentence)
+            if new is not None:
+                A.push(new)
+        A.make_passive(item)
+    return old_make_forest(A, ocfg)
+
+
+def old_earley(ocfg, sentence, start, A):
+    """earley.earley with the old representation (and the same left-corner prediction)"""
+    icfg = ocfg.icfg
+    predicted = dict()
+    for rule in ocfg.get(start):
+        A.push(OldItem(rule, [0]))
+    while A:
+        item = A.pop()
+        if item.is_complete() or icfg.is_nonterminal(item.next):
+            if not item.is_complete():
+                j = item.dot
+                if j not in predicted:
+                    word = sentence[j] if j < len(sentence) else None
+                    predicted[j] = (set(), set(ocfg.starting_with(word)))
+                done, viable = predicted[j]
+                if item.next not in done:
+                    for nonterminal in icfg.left_corners(item.next):
+                        if nonterminal in done:
+                            continue
+                        done.add(nonterminal)
+                        for rule in ocfg.get(nonterminal):
+                            if rule in viable:
+                                A.push(OldItem(rule, [j]))
+            for new in complete(item, A):
+                A.push(new)
+        else:
+            new = scan(item, sentence)
+            if new is not None:
+                A.push(new)
+        A.make_passive(item)
+    return old_make_forest(A, ocfg)
+
+
+def deep_sizeof(obj, seen=None):
+    """approximate size in bytes of an object and everything it holds (except rules)"""
+    if seen is None:
+        seen = set()
+    if id(obj) in seen or isinstance(obj, (Rule, OldRule)):
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        for key, value in obj.items():
+            size += deep_sizeof(key, seen) + deep_sizeof(value, seen)
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        for x in obj:
+            size += deep_sizeof(x, seen)
+    if hasattr(obj, '__dict__'):
+        size += deep_sizeof(obj.__dict__, seen)
+    for slot in getattr(type(obj), '__slots__', ()):
+        if hasattr(obj, slot):
+            size += deep_sizeof(getattr(obj, slot), seen)
+    return size
+
+
+def measure(parse, cfg, sentence, repeat=7, agenda=Agenda):
+    """return (number of items, seconds per parse, bytes of the agenda, number of axioms avoided)"""
+    best = None
+    for _ in range(repeat):
+        A = agenda()
+        stats = dict()
+        t0 = time.time()
+        parse(cfg, sentence, A, stats)
+        elapsed = time.time() - t0
+        best = elapsed if best is None else min(best, elapsed)
+    n_items = len(A._seen)
+    containers = (A._active, A._seen, A._incomplete, A._complete)
+    return n_items, best, deep_sizeof(containers), stats.get('avoided', 0)
+
+
+def main():
+    benchmarks = [
+        ('examples/ambiguous', '[E]', lambda n: ' + '.join(['a'] * ((n + 1) // 2)).split()),
+        ('examples/kallmeyer', '[S]', lambda n: ('John saw the man' + ' with the telescope' * ((n - 4) // 3)).split()),
+    ]
+    row = '{0:<12} {1:<7} {2:<4} {3:>4} {4:>7} {5:>9} {6:>8} {7:>9} {8:>11} {9:>8}'
+    print(row.format('grammar', 'parser', 'repr', 'n', 'items', 'ms', 'us/item', 'agenda KB', 'bytes/item', 'avoided'))
+    for path, start, make_sentence in benchmarks:
+        cfg = WCFG(read_grammar_rules(open(path)))
+        ocfg = OldGrammar(cfg.interned())
+        istart = cfg.vocab[start]
+        parsers = [('cky', 'new', Agenda, lambda sentence, A, stats: cky(cfg, sentence, A, stats)),
+                   ('cky', 'old', OldAgenda, lambda sentence, A, stats: old_cky(ocfg, intern_sentence(cfg, sentence), A, stats)),
+                   ('earley', 'new', Agenda, lambda sentence, A, stats: earley(cfg, sentence, start, A)),
+                   ('earley', 'old', OldAgenda, lambda sentence, A, stats: old_earley(ocfg, intern_sentence(cfg, sentence), istart, A))]
+        for name, representation, agenda, parse in parsers:
+            for n in (5, 11, 17, 29):
+                sentence = make_sentence(n)
+                n_items, seconds, agenda_bytes, avoided = measure(lambda cfg, sentence, A, stats: parse(sentence, A, stats),
+                                                                  cfg, sentence, agenda=agenda)
+                print(row.format(path.split('/')[-1], name, representation, len(sentence), n_items,
+                                 '%.1f' % (seconds * 1000), '%.1f' % (seconds * 1e6 / max(n_items, 1)),
+                                 '%.1f' % (agenda_bytes / 1024.0), '%.1f' % (agenda_bytes / float(max(n_items, 1))),
+                                 avoided if representation == 'new' else ''))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+"""
+Forests of a corpus, parsed once.
+
+Training (EM, Gibbs sampling) changes the probabilities of a grammar, never its rules,
+and the structure of a forest depends only on the rules. Thus we parse each sentence once
+and, at every iteration, reweight its forest with the current grammar (see Forest.reweighted).
+Repeated sentences are parsed once too (see corpus.WeightedCorpus).
+"""
+from parser import cky
+from corpus import weighted
+
+
+class ForestCache(object):
+
+    def __init__(self, grammar, sentences, start='[E]', parse=cky):
+        """
+        Parse a corpus.
+
+        :param grammar: a WCFG (only its rules matter)
+        :param sentences: a list of sentences (each a list or tuple of words) or a WeightedCorpus,
+            forests are indexed by distinct sentence
+        :param start: the start symbol
+        :param parse: a function (grammar, sentence) -> Forest, e.g. cky
+            or lambda cfg, sentence: earley(cfg, sentence, start)
+        """
+        self._num_rules = len(grammar)
+        self._corpus = weighted(sentences)
+        self._forests = []
+        self._goals = []
+        for sentence, _ in self._corpus:
+            forest = parse(grammar, sentence)
+            self._forests.append(forest)
+            self._goals.append(forest.node(start, 0, len(sentence)))
+
+    @property
+    def corpus(self):
+        """the WeightedCorpus of the forests"""
+        return self._corpus
+
+    def __len__(self):
+        """number of distinct sentences"""
+        return len(self._corpus)
+
+    def sentence(self, i):
+        return self._corpus.sentence(i)
+
+    def count(self, i):
+        """how many times the i-th sentence occurs in the corpus"""
+        return self._corpus.count(i)
+
+    def goal(self, i):
+        """the goal node of the i-th forest"""
+        return self._goals[i]
+
+    def forest(self, i, grammar=None):
+        """
+        The forest of the i-th sentence.
+
+        :param grammar: if given, the forest is reweighted with its probabilities
+            (it must have the rules of the grammar we parsed with, e.g. be a reweighted copy of it)
+        """
+        forest = self._forests[i]
+        if grammar is None:
+            return forest
+        if len(grammar) != self._num_rules:
+            raise ValueError('I parsed with %d rules, got a grammar with %d' % (self._num_rules, len(grammar)))
+        return forest.reweighted(grammar)
+
+    def forests(self, grammar=None):
+        """iterator over pairs (forest, goal), optionally reweighted with a grammar"""
+        for i in range(len(self._corpus)):
+            yield self.forest(i, grammar), self._goals[i]
@@ -1,33 +1,187 @@
 from collections import defaultdict, deque
-from symbol import is_terminal
+from symbol import is_terminal, Vocabulary
 from rule import Rule
+import numpy as np
+import copy
 import math
 
 
 class WCFG(object):
+    """
+    A weighted context-free grammar.
 
-    def __init__(self, rules=[]):
+    The structure of the grammar (its rules) is fixed once built: rules are identified by
+    their LHS and RHS, and each rule gets a stable integer id (the order in which it was added).
+    Probabilities live apart, in a NumPy vector indexed by rule id (see `probs`), which can be
+    updated in place or swapped (see `reweight`) without touching the rules.
+    """
+
+    def __init__(self, rules=[], vocab=None):
         self._rules = []
+        self._rule_ids = dict()
+        self._probs = np.zeros(0)
+        self._pending_probs = []  # probabilities of rules added since we last built the vector
         self._rules_by_lhs = defaultdict(list)
+        # the reverse index: for each symbol, pairs (rule, position) such that rule.rhs[position] is the symbol
+        self._rules_by_rhs = defaultdict(list)
         self._terminals = set()
         self._nonterminals = set()
+        self._vocab = Vocabulary() if vocab is None else vocab
+        self._interned = None
+        self._by_first_terminal = None  # see starting_with
+        self._left_corners = None  # see left_corners
+        self._lhs_index = None  # see lhs_index
         for rule in rules:
             self.add(rule)
 
     def add(self, rule):
+        """add a rule (with probability rule.prob) and return its id"""
+        if rule in self._rule_ids:
+            raise ValueError('I already have the rule %s' % rule)
+        self._intern(rule)
+        rule_id = len(self._rules)
+        self._rule_ids[rule] = rule_id
+        self._pending_probs.append(rule.prob)
         self._rules.append(rule)
+        self._by_first_terminal = None
+        self._left_corners = None
+        self._lhs_index = None
         self._rules_by_lhs[rule.lhs].append(rule)
         self._nonterminals.add(rule.lhs)
-        for s in rule.rhs:
-            if is_terminal(s):
+        for position, s in enumerate(rule.rhs):
+            self._rules_by_rhs[s].append((rule, position))
+            if self.is_terminal(s):
                 self._terminals.add(s)
             else:
                 self._nonterminals.add(s)
+        return rule_id
+
+    def _intern(self, rule):
+        """register the symbols of a rule in the vocabulary"""
+        self._vocab.add(rule.lhs)
+        for s in rule.rhs:
+            self._vocab.add(s)
+        self._interned = None
 
     def update(self, rules):
         for rule in rules:
             self.add(rule)
 
+    def is_terminal(self, symbol):
+        return is_terminal(symbol)
+
+    def is_nonterminal(self, symbol):
+        return not self.is_terminal(symbol)
+
+    @property
+    def vocab(self):
+        """a Vocabulary with the symbols of the grammar"""
+        return self._vocab
+
+    def interned(self):
+        """
+        The same grammar over the integer ids of its vocabulary (an InternedWCFG).
+
+        Rules keep their ids and the interned grammar shares our probability vector.
+        """
+        if self._interned is None:
+            vocab = self._vocab
+            self._interned = InternedWCFG(vocab, (Rule(vocab[r.lhs], [vocab[s] for s in r.rhs], r.prob)
+                                                  for r in self._rules))
+            self._interned._pending_probs = []
+            self._interned._probs = self.probs
+        return self._interned
+
+    @property
+    def probs(self):
+        """a vector with the probability of each rule (indexed by rule id)"""
+        if self._pending_probs:
+            self._probs = np.concatenate([self._probs, np.array(self._pending_probs, dtype=float)])
+            self._pending_probs = []
+            if self._interned is not None:
+                self._interned._probs = self._probs
+        return self._probs
+
+    def set_probs(self, probs):
+        """update the probabilities of all rules in place"""
+        self.probs[:] = probs
+
+    def reweight(self, probs):
+        """
+        Return a grammar with the same rules and a new probability vector.
+
+        The two grammars share their structure (no rule is copied or re-hashed), thus
+        rules must not be added to either of them.
+        """
+        probs = np.array(probs, dtype=float)
+        if probs.shape != self.probs.shape:
+            raise ValueError('I expected %d probabilities, got %d' % (len(self), len(probs)))
+        return self._with_probs(probs)
+
+    def _with_probs(self, probs):
+        """a shallow copy of the grammar (and of its interned version) that uses `probs`"""
+        grammar = copy.copy(self)
+        grammar._probs = probs
+        if self._interned is not None and self._interned is not self:
+            grammar._interned = self._interned._with_probs(probs)
+        return grammar
+
+    def copy(self):
+        """return a grammar with the same rules and a copy of the probability vector"""
+        return self.reweight(self.probs)
+
+    def rule_id(self, rule):
+        """the id of a rule (rules are identified by LHS and RHS, regardless of probability)"""
+        return self._rule_ids[rule]
+
+    def rule(self, rule_id):
+        """the rule with a given id"""
+        return self._rules[rule_id]
+
+    def lhs_index(self):
+        """
+        Group rules by LHS.
+
+        :returns: (lhs, index) where lhs is a list of the LHS symbols and index a vector such
+            that the rule with id r rewrites lhs[index[r]]
+        """
+        if self._lhs_index is None:
+            groups = dict()
+            lhs = []
+            index = np.zeros(len(self._rules), dtype=int)
+            for rule_id, rule in enumerate(self._rules):
+                group = groups.get(rule.lhs, None)
+                if group is None:
+                    group = len(lhs)
+                    groups[rule.lhs] = group
+                    lhs.append(rule.lhs)
+                index[rule_id] = group
+            self._lhs_index = (lhs, index)
+        return self._lhs_index
+
+    def normalize(self, counts):
+        """
+        Turn counts into probabilities: each count is divided by the total count of its LHS.
+
+        :param counts: a vector indexed by rule id (e.g. expected counts)
+        :returns: a probability vector indexed by rule id, the rules of a LHS
+            whose total count is zero keep their current probabilities
+        """
+        counts = np.asarray(counts, dtype=float)
+        lhs, index = self.lhs_index()
+        totals = np.bincount(index, weights=counts, minlength=len(lhs))[index]
+        probs = self.probs.copy()
+        seen = totals > 0.0
+        probs[seen] = counts[seen] / totals[seen]
+        return probs
+
+    def prob(self, rule):
+        """the probability of a rule"""
+        return self.probs[self._rule_ids[rule]]
+
+    def __contains__(self, rule):
+        return rule in self._rule_ids
+
     @property
     def nonterminals(self):
         return self._nonterminals
@@ -46,6 +200,122 @@ class WCFG(object):
         """rules whose LHS is the given symbol"""
         return self._rules_by_lhs.get(lhs, frozenset())
 
+    def incoming(self, symbol):
+        """rules whose LHS is the given symbol (same as `get`)"""
+        return self._rules_by_lhs.get(symbol, ())
+
+    def outgoing(self, symbol):
+        """pairs (rule, position) such that the given symbol is rule.rhs[position]"""
+        return self._rules_by_rhs.get(symbol, ())
+
+    def starting_with(self, terminal):
+        """
+        Rules that can start a span whose first word is `terminal`.
+
+        That is, rules X -> alpha such that alpha derives a string that starts with `terminal`
+        (either because alpha starts with it, or because it is in the left corner of alpha),
+        and rules that derive the empty string. The index is built once (until rules are added).
+
+        :returns: a list of rules in the order of their ids
+        """
+        if self._by_first_terminal is None:
+            self._by_first_terminal = self._index_first_terminals()
+        index, nullable_rules, _ = self._by_first_terminal
+        return index.get(terminal, nullable_rules)
+
+    def first_terminals(self, symbol):
+        """the terminals that can start a string derived from a symbol (a set)"""
+        if self.is_terminal(symbol):
+            return set([symbol])
+        if self._by_first_terminal is None:
+            self._by_first_terminal = self._index_first_terminals()
+        return self._by_first_terminal[2].get(symbol, set())
+
+    def left_corners(self, nonterminal):
+        """
+        The reflexive-transitive left-corner closure of a nonterminal.
+
+        That is, the nonterminals Y such that `nonterminal` =>* Y beta by rewriting the leftmost
+        symbol (after symbols that derive the empty string). The closure is built once
+        (until rules are added).
+
+        :returns: a list of nonterminals (starting with `nonterminal` itself)
+        """
+        if self._left_corners is None:
+            self._left_corners = self._left_corner_closures()
+        return self._left_corners.get(nonterminal, [nonterminal])
+
+    def _left_corner_closures(self):
+        nullable = self._nullable()
+        closures = dict()
+        for nonterminal in self._rules_by_lhs:
+            closure = [nonterminal]
+            seen = set(closure)
+            stack = [nonterminal]
+            while stack:
+                for rule in self._rules_by_lhs.get(stack.pop(), ()):
+                    for s in rule.rhs:
+                        if self.is_terminal(s):
+                            break
+                        if s not in seen:
+                            seen.add(s)
+                            closure.append(s)
+                            stack.append(s)
+                        if s not in nullable:
+                            break
+            closures[nonterminal] = closure
+        return closures
+
+    def _nullable(self):
+        """nonterminals that derive the empty string"""
+        nullable = set()
+        changed = True
+        while changed:
+            changed = False
+            for rule in self._rules:
+                if rule.lhs not in nullable and all(s in nullable for s in rule.rhs):
+                    nullable.add(rule.lhs)
+                    changed = True
+        return nullable
+
+    def _index_first_terminals(self):
+        nullable = self._nullable()
+
+        def first(rhs, firsts):
+            """terminals that can start a string derived from rhs (and whether rhs is nullable)"""
+            terminals = set()
+            for s in rhs:
+                if self.is_terminal(s):
+                    terminals.add(s)
+                    return terminals, False
+                terminals.update(firsts[s])
+                if s not in nullable:
+                    return terminals, False
+            return terminals, True
+
+        # the terminals that can start a string derived from each nonterminal (a fixed point)
+        firsts = defaultdict(set)
+        changed = True
+        while changed:
+            changed = False
+            for rule in self._rules:
+                terminals, _ = first(rule.rhs, firsts)
+                if not terminals <= firsts[rule.lhs]:
+                    firsts[rule.lhs].update(terminals)
+                    changed = True
+        index = defaultdict(list)
+        nullable_rules = []
+        for rule in self._rules:
+            terminals, is_nullable = first(rule.rhs, firsts)
+            for terminal in terminals:
+                index[terminal].append(rule)
+            if is_nullable:
+                nullable_rules.append(rule)
+        if nullable_rules:  # rules that derive the empty string can start anywhere
+            for terminal, rules in index.items():
+                index[terminal] = sorted(set(rules) | set(nullable_rules), key=self.rule_id)
+        return dict(index), nullable_rules, firsts
+
     def can_rewrite(self, lhs):
         """Whether a given nonterminal can be rewritten.
 
@@ -55,7 +325,7 @@ class WCFG(object):
         return lhs in self._rules_by_lhs
 
     def __iter__(self):
-        """iterator over rules (in arbitrary order)"""
+        """iterator over rules (in the order of their ids)"""
         return iter(self._rules)
     
     def iteritems(self):
@@ -66,10 +336,26 @@ class WCFG(object):
         lines = []
         for lhs, rules in self.iteritems():
             for rule in rules:
-                lines.append(str(rule))
+                lines.append(str(Rule(rule.lhs, rule.rhs, self.prob(rule))))
         return '\n'.join(lines)
 
 
+class InternedWCFG(WCFG):
+    """A WCFG whose symbols are ids in a Vocabulary (see WCFG.interned)."""
+
+    def __init__(self, vocab, rules=[]):
+        WCFG.__init__(self, rules, vocab=vocab)
+
+    def _intern(self, rule):
+        pass  # symbols are already ids
+
+    def is_terminal(self, symbol):
+        return self._vocab.is_terminal(symbol)
+
+    def interned(self):
+        return self
+
+
 def read_grammar_rules(istream):
     """Reads grammar rules formatted as 'LHS ||| RHS ||| PROB'."""
     for line in istream:
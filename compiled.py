@@ -0,0 +1,194 @@
+"""
+A binary format for grammars.
+
+Reading the text format (see cfg.read_grammar_rules) splits and converts every line and
+builds a Rule per line, which for large grammars takes seconds in every process that
+needs the grammar. `compile_grammar` writes a grammar once as flat arrays:
+
+    symbols           the vocabulary, as UTF-8 bytes with CSR offsets (symbol_offsets)
+    is_terminal       one flag per symbol
+    lhs               the LHS of each rule (indexed by rule id)
+    rhs               the RHS of all rules, concatenated, with CSR offsets (rhs_offsets)
+    probs             the probability vector (indexed by rule id)
+    by_lhs            rule ids grouped by LHS symbol, with CSR offsets (by_lhs_offsets)
+    by_rhs            pairs (rule id, position) grouped by RHS symbol, with CSR offsets (by_rhs_offsets)
+
+and `CompiledGrammar` memory-maps them: loading reads a small header and nothing else,
+and processes that load the same file share a single copy of it (the page cache).
+The file starts with a magic string, the length of a JSON header and the header, which
+gives the dtype, shape and offset of each array (offsets are multiples of 8).
+"""
+import json
+import struct
+import numpy as np
+from cfg import WCFG
+from rule import Rule
+from symbol import Vocabulary
+
+MAGIC = b'PCFGBIN1'
+_ALIGNMENT = 8
+
+# symbols are str, which is bytes in Python 2 (as read by cfg.read_grammar_rules)
+if str is bytes:
+    _encode = _decode = lambda symbol: symbol
+else:
+    _encode = lambda symbol: symbol.encode('utf-8')
+    _decode = lambda data: data.decode('utf-8')
+
+
+def compile_grammar(cfg, path):
+    """
+    Write a grammar in the binary format.
+
+    :param cfg: a WCFG
+    :param path: the output file
+    """
+    vocab = cfg.vocab
+    encoded = [_encode(symbol) for symbol in vocab]
+    rules = list(cfg)
+    arrays = [
+        ('symbols', np.frombuffer(b''.join(encoded), dtype=np.uint8)),
+        ('symbol_offsets', _offsets([len(s) for s in encoded])),
+        ('is_terminal', np.array([vocab.is_terminal(i) for i in range(len(vocab))], dtype=np.uint8)),
+        ('lhs', np.array([vocab[rule.lhs] for rule in rules], dtype=np.int32)),
+        ('rhs', np.array([vocab[sym] for rule in rules for sym in rule.rhs], dtype=np.int32)),
+        ('rhs_offsets', _offsets([len(rule.rhs) for rule in rules])),
+        ('probs', np.array(cfg.probs, dtype=np.float64)),
+    ]
+    lhs = arrays[3][1]
+    order = np.argsort(lhs, kind='mergesort')
+    arrays.append(('by_lhs', order.astype(np.int32)))
+    arrays.append(('by_lhs_offsets', _offsets(np.bincount(lhs, minlength=len(vocab)))))
+    rhs, rhs_offsets = arrays[4][1], arrays[5][1]
+    rule_of = np.repeat(np.arange(len(rules), dtype=np.int32), np.diff(rhs_offsets))
+    position = np.arange(len(rhs), dtype=np.int32) - rhs_offsets[:-1][rule_of].astype(np.int32)
+    order = np.argsort(rhs, kind='mergesort')
+    arrays.append(('by_rhs', np.stack([rule_of[order], position[order]], axis=1) if len(rhs) else
+                   np.zeros((0, 2), dtype=np.int32)))
+    arrays.append(('by_rhs_offsets', _offsets(np.bincount(rhs, minlength=len(vocab)))))
+    layout = dict()
+    offset = 0
+    for name, array in arrays:
+        layout[name] = [array.dtype.str, list(array.shape), offset]
+        offset = _aligned(offset + array.nbytes)
+    header = json.dumps(layout, sort_keys=True).encode('ascii')
+    start = _aligned(len(MAGIC) + 8 + len(header))
+    with open(path, 'wb') as ostream:
+        ostream.write(MAGIC)
+        ostream.write(struct.pack('<Q', len(header)))
+        ostream.write(header)
+        for name, array in arrays:
+            ostream.seek(start + layout[name][2])
+            ostream.write(np.ascontiguousarray(array).tobytes())
+        ostream.truncate(start + offset)
+
+
+def _offsets(lengths):
+    """CSR offsets: the items of row i are at [offsets[i], offsets[i + 1])"""
+    return np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+
+
+def _aligned(offset):
+    return (offset + _ALIGNMENT - 1) // _ALIGNMENT * _ALIGNMENT
+
+
+class CompiledGrammar(object):
+
+    def __init__(self, path):
+        """
+        Memory-map a grammar written by `compile_grammar` (arrays are read-only).
+
+        :param path: the binary file
+        """
+        with open(path, 'rb') as istream:
+            if istream.read(len(MAGIC)) != MAGIC:
+                raise ValueError('%s is not a compiled grammar' % path)
+            size, = struct.unpack('<Q', istream.read(8))
+            header = json.loads(istream.read(size).decode('ascii'))
+        start = _aligned(len(MAGIC) + 8 + size)
+        self._path = path
+        self._arrays = dict()
+        for name, (dtype, shape, offset) in header.items():
+            if int(np.prod(shape)) == 0:  # a memmap cannot be empty
+                self._arrays[name] = np.zeros(shape, dtype=dtype)
+            else:
+                self._arrays[name] = np.memmap(path, dtype=dtype, mode='r', offset=start + offset,
+                                               shape=tuple(shape))
+        self._vocab = None
+
+    def array(self, name):
+        """one of the arrays of the format (see the module docstring)"""
+        return self._arrays[name]
+
+    def __len__(self):
+        """number of rules"""
+        return len(self._arrays['lhs'])
+
+    def num_symbols(self):
+        return len(self._arrays['is_terminal'])
+
+    @property
+    def probs(self):
+        """the probability of each rule (indexed by rule id)"""
+        return self._arrays['probs']
+
+    def symbol(self, sym_id):
+        """the symbol (str) of an id"""
+        offsets = self._arrays['symbol_offsets']
+        return _decode(self._arrays['symbols'][offsets[sym_id]:offsets[sym_id + 1]].tobytes())
+
+    @property
+    def vocab(self):
+        """a Vocabulary with the same ids (decoded once, when first needed)"""
+        if self._vocab is None:
+            self._vocab = Vocabulary(self.symbol(i) for i in range(self.num_symbols()))
+        return self._vocab
+
+    def is_terminal(self, sym_id):
+        return bool(self._arrays['is_terminal'][sym_id])
+
+    def lhs(self, rule_id):
+        """the id of the LHS of a rule"""
+        return int(self._arrays['lhs'][rule_id])
+
+    def rhs(self, rule_id):
+        """the ids of the RHS of a rule"""
+        offsets = self._arrays['rhs_offsets']
+        return self._arrays['rhs'][offsets[rule_id]:offsets[rule_id + 1]]
+
+    def rules_by_lhs(self, sym_id):
+        """the ids of the rules that rewrite a symbol"""
+        offsets = self._arrays['by_lhs_offsets']
+        return self._arrays['by_lhs'][offsets[sym_id]:offsets[sym_id + 1]]
+
+    def rules_by_rhs(self, sym_id):
+        """an array of pairs (rule id, position) such that the symbol is the rule's RHS at the position"""
+        offsets = self._arrays['by_rhs_offsets']
+        return self._arrays['by_rhs'][offsets[sym_id]:offsets[sym_id + 1]]
+
+    def rule(self, rule_id):
+        """the Rule (over str symbols) with a given id"""
+        symbol = self.vocab.symbol
+        return Rule(symbol(self.lhs(rule_id)), [symbol(s) for s in self.rhs(rule_id).tolist()],
+                    float(self.probs[rule_id]))
+
+    def to_wcfg(self):
+        """
+        A WCFG with the same rules, rule ids and symbol ids.
+
+        This builds a Rule per rule (as the parsers in parser.py and earley.py need), but
+        without reading text; the dense parser can use the arrays directly (see DenseGrammar.from_compiled).
+        """
+        symbols = list(self.vocab)
+        lhs = self._arrays['lhs'].tolist()
+        rhs = self._arrays['rhs'].tolist()
+        offsets = self._arrays['rhs_offsets'].tolist()
+        probs = self.probs.tolist()
+        rules = (Rule(symbols[lhs[r]], [symbols[s] for s in rhs[offsets[r]:offsets[r + 1]]], probs[r])
+                 for r in range(len(lhs)))
+        return WCFG(rules, vocab=Vocabulary(symbols))
+
+
+def load_grammar(path):
+    """memory-map a compiled grammar (see CompiledGrammar)"""
+    return CompiledGrammar(path)
@@ -0,0 +1,68 @@
+"""
+A corpus of distinct sentences with counts.
+
+Generated corpora repeat many sentences (short ones in particular), and under a PCFG
+every occurrence of a sentence has the same forest, the same inside/outside weights and
+the same expected counts. Thus we parse and score each distinct sentence once and scale
+its contribution by how many times it occurs.
+"""
+
+
+class WeightedCorpus(object):
+
+    def __init__(self, sentences=[]):
+        """
+        Collapse identical sentences into (sentence, count) pairs.
+
+        :param sentences: a list of sentences (each a list or tuple of words), possibly
+            with repetitions; distinct sentences keep the order of their first occurrence
+        """
+        self._sentences = []
+        self._counts = []
+        self._index = dict()  # sentence -> its position in _sentences
+        for sentence in sentences:
+            self.add(sentence)
+
+    @classmethod
+    def from_counts(cls, pairs):
+        """a corpus from (sentence, count) pairs"""
+        corpus = cls()
+        for sentence, count in pairs:
+            corpus.add(sentence, count)
+        return corpus
+
+    def add(self, sentence, count=1):
+        """add occurrences of a sentence"""
+        sentence = tuple(sentence)
+        i = self._index.get(sentence, None)
+        if i is None:
+            self._index[sentence] = len(self._sentences)
+            self._sentences.append(sentence)
+            self._counts.append(count)
+        else:
+            self._counts[i] += count
+
+    def __len__(self):
+        """number of distinct sentences"""
+        return len(self._sentences)
+
+    def size(self):
+        """number of sentences, counting repetitions"""
+        return sum(self._counts)
+
+    def sentence(self, i):
+        return self._sentences[i]
+
+    def count(self, i):
+        return self._counts[i]
+
+    def __iter__(self):
+        """iterator over pairs (sentence, count)"""
+        return iter(zip(self._sentences, self._counts))
+
+
+def weighted(corpus):
+    """return a WeightedCorpus (collapsing a list of sentences, if necessary)"""
+    if isinstance(corpus, WeightedCorpus):
+        return corpus
+    return WeightedCorpus(corpus)
@@ -0,0 +1,453 @@
+"""
+A dense CKY program for grammars in Chomsky normal form.
+
+The grammar is compiled into NumPy arrays (one entry per binary rule and a
+terminal-by-nonterminal matrix for lexical rules) and the inside chart is an
+(n + 1) x (n + 1) x |N| array which we fill one span width at a time,
+handling all spans of that width and all their split points at once.
+Unit rules X -> Y are allowed too: within a cell they are summed up in closed form.
+
+Because the chart is filled span by span, it can also be pruned as it is filled
+(see inside_chart): per-cell beams, thresholds relative to the best item of a cell,
+and masks of the cells a coarser grammar found likely (see coarse_to_fine).
+"""
+import math
+import numpy as np
+from cfg import WCFG
+from rule import Rule
+from symbol import is_terminal, is_nonterminal, make_symbol
+from parser import cky
+
+
+class DenseGrammar(object):
+    """A WCFG in Chomsky normal form compiled into NumPy arrays."""
+
+    def __init__(self, cfg):
+        """
+        :param cfg: a WCFG whose rules are either X -> Y Z, X -> Y or X -> x
+        """
+        nonterminals = sorted(cfg.nonterminals)
+        terminals = sorted(cfg.terminals)
+        nonterminal_index = dict((sym, i) for i, sym in enumerate(nonterminals))
+        terminal_index = dict((sym, i) for i, sym in enumerate(terminals))
+        binary = []
+        lexical = np.zeros((len(terminals), len(nonterminals)))
+        unit = np.zeros((len(nonterminals), len(nonterminals)))
+        for rule, prob in zip(cfg, cfg.probs):
+            lhs = nonterminal_index[rule.lhs]
+            if len(rule.rhs) == 2 and all(is_nonterminal(sym) for sym in rule.rhs):
+                binary.append((lhs,
+                               nonterminal_index[rule.rhs[0]],
+                               nonterminal_index[rule.rhs[1]],
+                               prob))
+            elif len(rule.rhs) == 1 and is_terminal(rule.rhs[0]):
+                lexical[terminal_index[rule.rhs[0]], lhs] += prob
+            elif len(rule.rhs) == 1:
+                unit[lhs, nonterminal_index[rule.rhs[0]]] += prob
+            else:
+                raise ValueError('I expected a grammar in CNF, got %s' % rule)
+        self._build(nonterminals, terminals,
+                    np.array([r[0] for r in binary], dtype=int),
+                    np.array([r[1] for r in binary], dtype=int),
+                    np.array([r[2] for r in binary], dtype=int),
+                    np.array([r[3] for r in binary], dtype=float),
+                    lexical, unit)
+
+    @classmethod
+    def from_compiled(cls, compiled):
+        """
+        Build a DenseGrammar straight from the arrays of a CompiledGrammar (see compiled.py),
+        without making a Rule per rule.
+        """
+        symbols = list(compiled.vocab)
+        is_terminal = compiled.array('is_terminal').astype(bool)
+        lhs = np.asarray(compiled.array('lhs'), dtype=int)
+        rhs = np.asarray(compiled.array('rhs'), dtype=int)
+        offsets = np.asarray(compiled.array('rhs_offsets'), dtype=int)
+        probs = np.asarray(compiled.probs, dtype=float)
+        # nonterminals and terminals are sorted as in __init__, index maps a symbol id to its position
+        used = np.zeros(len(symbols), dtype=bool)
+        used[lhs] = True
+        used[rhs] = True
+        nonterminal_ids = sorted(np.flatnonzero(used & ~is_terminal).tolist(), key=lambda i: symbols[i])
+        terminal_ids = sorted(np.flatnonzero(used & is_terminal).tolist(), key=lambda i: symbols[i])
+        index = np.zeros(len(symbols), dtype=int)
+        index[nonterminal_ids] = np.arange(len(nonterminal_ids))
+        index[terminal_ids] = np.arange(len(terminal_ids))
+        length = np.diff(offsets)
+        first = rhs[np.minimum(offsets[:-1], max(len(rhs) - 1, 0))] if len(rhs) else np.zeros(len(lhs), dtype=int)
+        second = rhs[np.minimum(offsets[:-1] + 1, max(len(rhs) - 1, 0))] if len(rhs) else first
+        is_binary = (length == 2) & ~is_terminal[first] & ~is_terminal[second]
+        is_lexical = (length == 1) & is_terminal[first]
+        is_unit = (length == 1) & ~is_terminal[first]
+        if not (is_binary | is_lexical | is_unit).all():
+            bad = np.flatnonzero(~(is_binary | is_lexical | is_unit))[0]
+            raise ValueError('I expected a grammar in CNF, got %s' % compiled.rule(bad))
+        n, t = len(nonterminal_ids), len(terminal_ids)
+        lexical = np.zeros((t, n))
+        np.add.at(lexical, (index[first[is_lexical]], index[lhs[is_lexical]]), probs[is_lexical])
+        unit = np.zeros((n, n))
+        np.add.at(unit, (index[lhs[is_unit]], index[first[is_unit]]), probs[is_unit])
+        grammar = cls.__new__(cls)
+        grammar._build([symbols[i] for i in nonterminal_ids], [symbols[i] for i in terminal_ids],
+                       index[lhs[is_binary]], index[first[is_binary]], index[second[is_binary]],
+                       probs[is_binary], lexical, unit)
+        return grammar
+
+    def _build(self, nonterminals, terminals, lhs, left, right, prob, lexical, unit):
+        """set up the arrays from binary rules (as parallel vectors), the lexical matrix and the unit matrix"""
+        self._nonterminals = nonterminals
+        self._terminals = terminals
+        self._nonterminal_index = dict((sym, i) for i, sym in enumerate(nonterminals))
+        self._terminal_index = dict((sym, i) for i, sym in enumerate(terminals))
+        self._lexical = lexical
+        # binary rules are sorted by LHS so that rule scores can be summed per LHS segment
+        order = np.argsort(lhs, kind='mergesort')
+        self._lhs = lhs[order]
+        self._left = left[order]
+        self._right = right[order]
+        self._prob = prob[order]
+        # first rule of each LHS segment and the LHS it rewrites
+        if len(self._lhs):
+            self._segments = np.flatnonzero(np.r_[True, self._lhs[1:] != self._lhs[:-1]])
+        else:
+            self._segments = np.zeros(0, dtype=int)
+        self._segment_lhs = self._lhs[self._segments]
+        # the same segments over left and right children (for the outside recursion)
+        self._by_left = _segments(self._left)
+        self._by_right = _segments(self._right)
+        # chains of unit rules: U[X, Y] = sum of the probabilities of X =>* Y through unit rules
+        self._unit = None
+        if unit.any():
+            self._unit = np.linalg.inv(np.eye(len(nonterminals)) - unit)
+            if (self._unit < 0).any():
+                raise ValueError('I cannot sum up the unit rules: their chains diverge')
+
+    @property
+    def nonterminals(self):
+        """nonterminals in the order of the last axis of the chart"""
+        return self._nonterminals
+
+    @property
+    def terminals(self):
+        return self._terminals
+
+    def index(self, nonterminal):
+        """position of a nonterminal in the last axis of the chart"""
+        return self._nonterminal_index[nonterminal]
+
+    def lexical(self, terminal):
+        """a vector with the probability of each nonterminal rewriting as `terminal`"""
+        t = self._terminal_index.get(terminal, None)
+        if t is None:  # unknown words cannot be rewritten by any nonterminal
+            return np.zeros(len(self._nonterminals))
+        return self._lexical[t]
+
+    def binary(self, left, right):
+        """
+        Combine the inside weights of adjacent spans.
+
+        :param left: inside weights of left children with shape (spans, splits, |N|)
+        :param right: inside weights of right children with shape (spans, splits, |N|)
+        :returns: inside weights of the parent spans with shape (spans, |N|)
+        """
+        out = np.zeros((left.shape[0], len(self._nonterminals)))
+        if len(self._prob) == 0:
+            return out
+        # for each rule X -> Y Z: p(X -> Y Z) * sum_k I(Y, i, k) * I(Z, k, j)
+        scores = np.einsum('skr,skr->sr', left[:, :, self._left], right[:, :, self._right]) * self._prob
+        out[:, self._segment_lhs] = np.add.reduceat(scores, self._segments, axis=1)
+        return out
+
+    def close(self, cells):
+        """
+        Apply unit rules to the inside weights of cells.
+
+        :param cells: inside weights (of non-unit rules) with shape (spans, |N|)
+        :returns: inside weights with shape (spans, |N|)
+        """
+        if self._unit is None:
+            return cells
+        return cells.dot(self._unit.T)
+
+    def close_outside(self, cells):
+        """the outside weights of the non-unit items of cells, given the outside weights of the cells"""
+        if self._unit is None:
+            return cells
+        return cells.dot(self._unit)
+
+    def binary_outside(self, parent, left, right):
+        """
+        Pass the outside weights of parent spans on to their children.
+
+        :param parent: outside weights (of non-unit items) of the parent spans with shape (spans, |N|)
+        :param left: inside weights of left children with shape (spans, splits, |N|)
+        :param right: inside weights of right children with shape (spans, splits, |N|)
+        :returns: outside contributions to the left and the right children,
+            each with shape (spans, splits, |N|)
+        """
+        left_out = np.zeros(left.shape)
+        right_out = np.zeros(right.shape)
+        if len(self._prob) == 0:
+            return left_out, right_out
+        # for each rule X -> Y Z: O(Y, i, k) += p(X -> Y Z) O(X, i, j) I(Z, k, j) (and likewise for Z)
+        top = (parent[:, self._lhs] * self._prob)[:, None, :]
+        for out, scores, (order, segments, symbols) in ((left_out, top * right[:, :, self._right], self._by_left),
+                                                        (right_out, top * left[:, :, self._left], self._by_right)):
+            out[:, :, symbols] = np.add.reduceat(scores[:, :, order], segments, axis=2)
+        return left_out, right_out
+
+
+def _segments(symbols):
+    """the order that sorts rules by a child symbol, where each segment starts and its symbol"""
+    order = np.argsort(symbols, kind='mergesort')
+    sorted_symbols = symbols[order]
+    segments = np.flatnonzero(np.r_[True, sorted_symbols[1:] != sorted_symbols[:-1]]) if len(order) else order
+    return order, segments, sorted_symbols[segments]
+
+
+def inside_chart(grammar, sentence, beam=None, threshold=None, allowed=None, stats=None):
+    """
+    The inside recursion of CKY with a dense chart.
+
+    Optionally, each cell (span) is pruned as soon as it is filled, before larger spans use it:
+        allowed: only nonterminals allowed in a cell are kept (e.g. a mask from `coarse_to_fine`)
+        threshold: nonterminals whose inside weight is below `threshold` times the best one in the cell are dropped
+        beam: only the `beam` best nonterminals of a cell are kept
+    (beam and threshold spare the cell of the whole sentence, where only the start symbol matters).
+    Items of a cell are compared by inside weight (their outside weight is unknown while we fill the chart).
+
+    :param grammar: a DenseGrammar (or a WCFG in CNF, which we compile)
+    :param sentence: the input sentence (as a list or tuple)
+    :param beam: maximum number of nonterminals per cell
+    :param threshold: a number between 0 and 1
+    :param allowed: a boolean array with the shape of the chart
+    :param stats: if given, a dictionary where we count the nonzero 'items' before pruning and the 'kept' ones
+    :returns: an array C such that C[i, j, grammar.index(X)] is the inside weight of X spanning from i to j
+    """
+    if not isinstance(grammar, DenseGrammar):
+        grammar = DenseGrammar(grammar)
+    n = len(sentence)
+    chart = np.zeros((n + 1, n + 1, len(grammar.nonterminals)))
+    for width in range(1, n + 1):
+        starts = np.arange(n - width + 1)[:, None]  # one row per span
+        if width == 1:
+            cells = np.array([grammar.lexical(word) for word in sentence]).reshape(n, -1)
+        else:
+            splits = starts + np.arange(1, width)[None, :]  # one column per split point
+            cells = grammar.binary(chart[starts, splits], chart[splits, starts + width])
+        cells = grammar.close(cells)
+        if beam is not None or threshold is not None or allowed is not None:
+            mask = allowed[starts[:, 0], starts[:, 0] + width] if allowed is not None else None
+            if width == n:  # the goal competes with nothing in the cell of the whole sentence
+                cells = prune(cells, allowed=mask, stats=stats)
+            else:
+                cells = prune(cells, beam, threshold, mask, stats)
+        chart[starts[:, 0], starts[:, 0] + width] = cells
+    return chart
+
+
+def prune(cells, beam=None, threshold=None, allowed=None, stats=None):
+    """
+    Prune the nonterminals of a number of cells (see inside_chart).
+
+    :param cells: inside weights with shape (spans, |N|)
+    :returns: the pruned inside weights
+    """
+    if stats is not None:
+        stats['items'] = stats.get('items', 0) + int(np.count_nonzero(cells))
+    if allowed is not None:
+        cells = np.where(allowed, cells, 0.0)
+    if threshold is not None:
+        best = cells.max(axis=1)[:, None]
+        cells = np.where(cells >= threshold * best, cells, 0.0)
+    if beam is not None and beam < cells.shape[1]:
+        # everything but the `beam` best of each row
+        worst = np.argsort(-cells, axis=1, kind='mergesort')[:, beam:]
+        cells = cells.copy()
+        cells[np.arange(cells.shape[0])[:, None], worst] = 0.0
+    if stats is not None:
+        stats['kept'] = stats.get('kept', 0) + int(np.count_nonzero(cells))
+    return cells
+
+
+def outside_chart(grammar, sentence, chart, start):
+    """
+    The outside recursion over a dense inside chart.
+
+    :param grammar: a DenseGrammar
+    :param sentence: the input sentence (as a list or tuple)
+    :param chart: the inside chart (as returned by inside_chart, possibly pruned)
+    :param start: the start symbol
+    :returns: an array O with the shape of the chart such that O[i, j, grammar.index(X)] is the
+        outside weight of X spanning from i to j
+    """
+    n = len(sentence)
+    outside = np.zeros(chart.shape)
+    if n == 0:
+        return outside
+    outside[0, n, grammar.index(start)] = 1.0
+    for width in range(n, 0, -1):
+        starts = np.arange(n - width + 1)[:, None]
+        # all parents of the cells of this width are wider: their outside weights are complete
+        # and reach the items of the cell also through chains of unit rules
+        cells = grammar.close_outside(outside[starts[:, 0], starts[:, 0] + width])
+        outside[starts[:, 0], starts[:, 0] + width] = cells
+        if width == 1:
+            break
+        splits = starts + np.arange(1, width)[None, :]
+        left, right = grammar.binary_outside(cells, chart[starts, splits], chart[splits, starts + width])
+        # within a width, the (start, split) pairs and the (split, end) pairs are distinct
+        outside[starts, splits] += left
+        outside[splits, starts + width] += right
+    # items over pruned (zero) cells have no outside weight
+    return np.where(chart > 0.0, outside, 0.0)
+
+
+def posteriors(grammar, sentence, start, chart=None):
+    """
+    Posterior probability of each nonterminal spanning each span, I(X, i, j) O(X, i, j) / Z.
+
+    :param chart: an inside chart (by default the exhaustive one)
+    :returns: (posteriors with the shape of the chart, Z)
+    """
+    if chart is None:
+        chart = inside_chart(grammar, sentence)
+    n = len(sentence)
+    Z = chart[0, n, grammar.index(start)] if n else 0.0
+    if Z == 0.0:
+        return np.zeros(chart.shape), 0.0
+    return chart * outside_chart(grammar, sentence, chart, start) / Z, Z
+
+
+def project(cfg, projection):
+    """
+    A coarse grammar whose nonterminals are projections of those of a fine grammar.
+
+    A coarse rule gets the average probability (over the fine nonterminals that project
+    onto its LHS) of the fine rules that project onto it, thus if the fine grammar is proper
+    so is the coarse one.
+
+    :param cfg: a WCFG
+    :param projection: a function from fine nonterminals to coarse ones (str to str)
+    :returns: a WCFG
+    """
+    size = dict()  # coarse nonterminal -> number of fine nonterminals projected onto it
+    for lhs in cfg.nonterminals:
+        coarse = projection(lhs)
+        size[coarse] = size.get(coarse, 0) + 1
+    probs = dict()
+    order = []
+    for rule in cfg:
+        key = (projection(rule.lhs), tuple(projection(sym) if is_nonterminal(sym) else sym for sym in rule.rhs))
+        if key not in probs:
+            probs[key] = 0.0
+            order.append(key)
+        probs[key] += cfg.prob(rule)
+    return WCFG(Rule(lhs, rhs, probs[(lhs, rhs)] / size[lhs]) for lhs, rhs in order)
+
+
+def coarse_to_fine(grammar, coarse, projection, sentence, start, threshold=1e-4):
+    """
+    Cells a coarse grammar finds likely.
+
+    We parse with the coarse grammar and allow the fine nonterminal X over (i, j) whenever the
+    posterior of its projection over (i, j) is at least `threshold`.
+
+    :param grammar: the fine DenseGrammar
+    :param coarse: the coarse DenseGrammar (see project)
+    :param projection: a function from fine nonterminals to coarse ones
+    :param start: the start symbol of the fine grammar
+    :returns: a boolean array with the shape of the fine chart (see inside_chart)
+    """
+    coarse_posteriors, _ = posteriors(coarse, sentence, projection(start))
+    columns = [coarse.index(projection(X)) for X in grammar.nonterminals]
+    return coarse_posteriors[:, :, columns] >= threshold
+
+
+def pruning_report(grammar, sentence, start, beam=None, threshold=None, allowed=None):
+    """
+    What pruning drops, and what it costs.
+
+    :returns: a dictionary with
+        items: number of nonzero items of the exhaustive chart
+        kept: number of items that survived pruning
+        dropped: the fraction of items that did not
+        likelihood: the exhaustive probability of the sentence, Z
+        pruned_likelihood: the probability of the sentence in the pruned chart
+        log_likelihood_cost: log Z - log Z_pruned (inf if pruning lost every derivation)
+        recall: the fraction of the expected number of constituents (sum of the exhaustive
+            posteriors) that lies in cells which survived pruning
+    """
+    if not isinstance(grammar, DenseGrammar):
+        grammar = DenseGrammar(grammar)
+    n = len(sentence)
+    s = grammar.index(start)
+    exhaustive = inside_chart(grammar, sentence)
+    pruned = inside_chart(grammar, sentence, beam, threshold, allowed)
+    P, Z = posteriors(grammar, sentence, start, exhaustive)
+    Z_pruned = pruned[0, n, s]
+    items = int(np.count_nonzero(exhaustive))
+    kept = int(np.count_nonzero(pruned))
+    return dict(items=items,
+                kept=kept,
+                dropped=1.0 - kept / float(max(items, 1)),
+                likelihood=Z,
+                pruned_likelihood=Z_pruned,
+                log_likelihood_cost=math.log(Z) - math.log(Z_pruned) if Z_pruned > 0.0 else float('inf'),
+                recall=P[pruned > 0.0].sum() / P.sum() if Z > 0.0 else 0.0)
+
+
+def pruned_cky(cfg, sentence, start, beam=None, threshold=None, coarse=None, projection=None, coarse_threshold=1e-4):
+    """
+    Parse with CKY into a Forest, keeping only the items of a pruned dense chart.
+
+    :param cfg: a WCFG in CNF (unit rules allowed)
+    :param sentence: the input sentence (as a list or tuple)
+    :param start: the start symbol
+    :param beam: see inside_chart
+    :param threshold: see inside_chart
+    :param coarse: a coarse WCFG (see project) for coarse-to-fine pruning
+    :param projection: the function that projects the nonterminals of cfg onto those of coarse
+    :param coarse_threshold: see coarse_to_fine
+    :returns: a Forest (use `forest.node(start, 0, len(sentence))` to get the goal node)
+    """
+    grammar = DenseGrammar(cfg)
+    allowed = None
+    if coarse is not None:
+        allowed = coarse_to_fine(grammar, DenseGrammar(coarse), projection, sentence, start, coarse_threshold)
+    chart = inside_chart(grammar, sentence, beam, threshold, allowed)
+    vocab = cfg.vocab
+    columns = dict((vocab[X], grammar.index(X)) for X in grammar.nonterminals)
+    return cky(cfg, sentence, allowed=lambda sym, i, j: chart[i, j, columns[sym]] > 0.0)
+
+
+def dense_inside(grammar, sentence, forest=None):
+    """
+    Inside weights as computed by `inside` on the forest produced by `cky`.
+
+    :param grammar: a DenseGrammar (or a WCFG in CNF, which we compile)
+    :param sentence: the input sentence (as a list or tuple)
+    :param forest: if given, the forest `cky` produced for the sentence, whose nodes are
+        then the keys (as in `inside`)
+    :returns: a dictionary mapping a symbol (terminal or nonterminal) to its inside weight;
+        symbols are nodes of `forest` if given, otherwise strings, where nonterminals are
+        formatted as in the forest (e.g. [S:0-5]); nonterminals with zero inside weight are omitted
+        (unlike `inside`, we also keep the nodes that are not under the goal node)
+    """
+    if not isinstance(grammar, DenseGrammar):
+        grammar = DenseGrammar(grammar)
+    chart = inside_chart(grammar, sentence)
+    I = dict()
+    if forest is None:
+        for sym in sentence:
+            I[sym] = 1.0
+        for i, j, x in zip(*np.nonzero(chart)):
+            I[make_symbol(grammar.nonterminals[x], i, j)] = float(chart[i, j, x])
+        return I
+    for node in range(forest.num_nodes()):
+        if forest.is_terminal(node):
+            I[node] = 1.0
+    for i, j, x in zip(*np.nonzero(chart)):
+        I[forest.node(grammar.nonterminals[x], int(i), int(j))] = float(chart[i, j, x])
+    return I
@@ -1,27 +1,9 @@
 from cfg import read_grammar_rules, WCFG
 from rule import Rule
-from symbol import is_terminal, is_nonterminal, make_symbol
 from collections import defaultdict
 from item import Item
 from agenda import Agenda
-
-def cky_axioms(cfg, sentence):
-    """
-    Axioms for CKY.
-    
-    Inference rule:
-        -------------------- (X -> alpha) in cfg and 0 <= i < n
-        [X -> * alpha, [i]]
-    
-    :param cfg: a context-free grammar (an instance of WCFG)
-    :param sentence: the input sentence (as a list or tuple)
-    :returns: a list of items
-    """
-    items = []
-    for rule in cfg:
-        for i in range(len(sentence)):  # from zero to n-1
-            items.append(Item(rule, [i]))
-    return items
+from parser import cky_axioms, scan, complete, make_forest, make_chart, intern_sentence, cky
 
 def earley_axioms(cfg, sentence, start):
     """
@@ -29,140 +11,83 @@ def earley_axioms(cfg, sentence, start):
 
     Inference rule:
         -------------------- (S -> alpha) in cfgs
-        [S -> * alpha, [0]] 
+        [S -> * alpha, 0, 0] 
 
-    :param cfg: a context-free grammar (an instance of WCFG)
-    :param sentence: the input sentence (as a list or tuple)
+    :param cfg: a context-free grammar (an instance of InternedWCFG)
+    :param sentence: the input sentence (as a list or tuple of terminal ids)
+    :param start: the id of the start symbol
     :returns: a list of items that are Earley axioms  
     """
     items = []
     for rule in cfg.get(start):
-        items.append(Item(rule, [0]))
+        items.append(Item(rule, 0))
     return items
 
-def predict(cfg, item):
+def predict(cfg, item, sentence, predicted):
     """
     Prediction for Earley.
 
     Inference rule:
-        -------------------- (SS -> alpha) in cfgs
-        [S -> * alpha, [0]] 
+        [X -> alpha * Y beta, i, j]
+        --------------------------- (Z -> gamma) in cfg, Y =>* Z delta (left corner) and gamma =>* sentence[j] ...
+        [Z -> * gamma, j, j]
 
-    :param cfg: a context-free grammar (an instance of WCFG)
-    :param item: an active Item
-    :returns: a list of predicted Items or None  
-    """
-    items = []
-    rules = cfg.get(item.next)
-    for rule in rules:
-            items.append(Item(rule, [item.dot]))
-    return items
+    Rather than predicting the rules of Y now and those of its left corners when their items
+    are popped, we predict at once every rule in the left-corner closure of Y (see WCFG.left_corners)
+    that can start with the word at position j (one-token lookahead, see WCFG.starting_with).
+    Thus each nonterminal is predicted at most once per position.
 
-def scan(item, sentence):
-    """
-    Scan a terminal (compatible with CKY and Earley).
-    
-    Inference rule:
-    
-        [X -> alpha * x beta, [i ... j]]
-        ------------------------------------    sentence[j] == x
-        [X -> alpha x * beta, [i ... j + 1]]
-    
+    :param cfg: a context-free grammar (an instance of InternedWCFG)
     :param item: an active Item
-    :param sentence: a list/tuple of terminals
-    :returns: an Item or None
-    """
-    assert is_terminal(item.next), 'Only terminal symbols can be scanned, got %s' % item.next
-    if item.dot < len(sentence) and sentence[item.dot] == item.next:
-        return item.advance(item.dot + 1)
-    else:
-        return None
-    
-def complete(item, agenda):
-    """
-    Move dot over nonterminals (compatible with CKY and Earley).
-    
-    Inference rule:
-    
-        [X -> alpha * Y beta, [i ... k]] [Y -> gamma *, [k ... j]]
-        ----------------------------------------------------------
-                 [X -> alpha Y * beta, [i ... j]]
-                 
-    :param item: an active Item.
-        if `item` is complete, we advance the dot of incomplete passive items to `item.dot`
-        otherwise, we check whether we know a set of positions J = {j1, j2, ..., jN} such that we can
-        advance this item's dot to.
-    :param agenda: an instance of Agenda
-    :returns: a list of items
+    :param sentence: the input sentence (as a list or tuple of terminal ids)
+    :param predicted: a dictionary that maps a position to a pair (nonterminals predicted there,
+        set of rules that can start there), filled as we go
+    :returns: a list of predicted Items
     """
     items = []
     if item.is_complete():
-        # advance the dot for incomplete items waiting for item.lhs spanning from item.start
-        for incomplete in agenda.waiting(item.lhs, item.start):
-            items.append(incomplete.advance(item.dot))
-    else:
-        # look for completions of item.next spanning from item.dot
-        ends = set()
-        for complete in agenda.complete(item.next, item.dot):
-            ends.add(complete.dot)
-        # advance the dot of the input item for each position that complete a span
-        for end in ends:
-            items.append(item.advance(end))
+        return items
+    j = item.dot
+    if j not in predicted:
+        word = sentence[j] if j < len(sentence) else None  # at the end only empty RHSs are viable
+        predicted[j] = (set(), set(cfg.starting_with(word)))
+    done, viable = predicted[j]
+    if item.next in done:
+        return items
+    for nonterminal in cfg.left_corners(item.next):
+        if nonterminal in done:  # and so is its own closure
+            continue
+        done.add(nonterminal)
+        for rule in cfg.get(nonterminal):
+            if rule in viable:
+                items.append(Item(rule, j))
     return items
 
-
-
-def make_forest(complete_items):
-    """
-    Turn complete items into a WCFG.
-    
-    :param complete_items: complete items (iterable)
-    :returns: a WCFG
+def earley(cfg, sentence, start, agenda=None):
     """
-    forest = WCFG()
-    for item in complete_items:
-        lhs = make_symbol(item.lhs, item.start, item.dot)
-        rhs = []
-        for i, sym in enumerate(item.rule.rhs):
-            rhs.append(make_symbol(sym, item.state(i), item.state(i + 1)))
-        forest.add(Rule(lhs, rhs, item.rule.prob))
-    return forest
+    Parse a sentence with Earley.
 
-def make_chart(complete_items, n):
-    chart = [[defaultdict(list) for j in range(n)] for i in range(n)] # n by n matrix with edges
-    for item in complete_items:
-        chart[item.start][item.dot][item.lhs].append((item.rule, item.dots_))
-    return chart
-                
-def cky(cfg, sentence):
-    A = Agenda()
-    for item in cky_axioms(cfg, sentence):
-        A.push(item)
-    while A:
-        item = A.pop()
-        if item.is_complete() or is_nonterminal(item.next):
-            for new in complete(item, A):
-                A.push(new)
-        else:
-            new = scan(item, sentence)
-            if new is not None:
-                A.push(new)
-        A.make_passive(item)
-    return make_forest(A.itercomplete())
-
-def earley(cfg, sentence, start):
-    A = Agenda()
-    for item in earley_axioms(cfg, sentence, start):
+    :param cfg: a WCFG
+    :param sentence: the input sentence (as a list or tuple)
+    :param start: the start symbol (str)
+    :param agenda: an empty Agenda to run the program with (by default a new one)
+    :returns: a Forest (use `forest.node(start, 0, len(sentence))` to get the goal node)
+    """
+    icfg = cfg.interned()
+    sentence = intern_sentence(cfg, sentence)
+    A = Agenda() if agenda is None else agenda
+    predicted = dict()  # position -> (nonterminals predicted there, rules that can start there)
+    for item in earley_axioms(icfg, sentence, cfg.vocab[start]):
         A.push(item)
     while len(A) > 0:
         item = A.pop()
         # print 'item is: {}'.format(item)
         # print 'next item is: {}'.format(item.next)
-        if item.is_complete() or is_nonterminal(item.next):
+        if item.is_complete() or icfg.is_nonterminal(item.next):
             # print 'predict:'
             # print predict(cfg, item)
             # print '\n'
-            for new in predict(cfg, item):
+            for new in predict(icfg, item, sentence, predicted):
                 # print new
                 A.push(new)
 
@@ -180,18 +105,4 @@ def earley(cfg, sentence, start):
             if new is not None:
                 A.push(new)
         A.make_passive(item)
-    return make_forest(A.itercomplete())
-
-
-
-
-
-
-
-
-
-
-
-
-
-    
\ No newline at end of file
+    return make_forest(A, icfg)
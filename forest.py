@@ -0,0 +1,156 @@
+"""
+A packed forest of derivations.
+
+A forest is a WCFG whose symbols are integer nodes. Each node stands for a triple
+(sym_id, start, end) where sym_id is the id of a grammar symbol in a Vocabulary.
+Strings such as [S:0-5] are only made when rendering the forest for output.
+"""
+from collections import defaultdict
+import numpy as np
+from cfg import WCFG
+from rule import Rule
+from symbol import make_symbol
+
+
+class Forest(WCFG):
+
+    def __init__(self, vocab, rules=[]):
+        """
+        :param vocab: the Vocabulary of the grammar we parsed with
+        :param rules: edges whose symbols are nodes (see `make_node`)
+        """
+        self._nodes = []  # node -> (sym_id, start, end)
+        self._node_ids = dict()  # (sym_id, start, end) -> node
+        self._incoming_edges = defaultdict(list)  # node -> ids of the edges whose head is the node
+        self._topological = dict()  # root -> nodes in bottom-up order (see topological_order)
+        self._edge_rule_ids = []  # edge id -> id of the grammar rule the edge instantiates (or None)
+        WCFG.__init__(self, rules, vocab=vocab)
+
+    def _intern(self, rule):
+        pass  # symbols are already nodes
+
+    def add(self, rule, rule_id=None):
+        """
+        Add an edge and return its id.
+
+        :param rule: an edge whose symbols are nodes
+        :param rule_id: the id of the grammar rule the edge instantiates (see `reweighted`)
+        """
+        edge = WCFG.add(self, rule)
+        self._incoming_edges[rule.lhs].append(edge)
+        self._edge_rule_ids.append(rule_id)
+        self._topological = dict()
+        return edge
+
+    def grammar_rule_id(self, edge):
+        """the id of the grammar rule an edge instantiates (or None)"""
+        return self._edge_rule_ids[edge]
+
+    def grammar_rule_ids(self):
+        """a vector with the id of the grammar rule of each edge (indexed by edge id)"""
+        if None in self._edge_rule_ids:
+            raise ValueError('I have edges that do not come from grammar rules')
+        return np.array(self._edge_rule_ids, dtype=int)
+
+    def reweighted(self, grammar):
+        """
+        Return this forest with the probabilities of `grammar`.
+
+        The structure of a forest depends only on the rules of the grammar we parsed with, not on
+        their probabilities, thus for a grammar with the same rules (e.g. one returned by
+        `WCFG.reweight`) we need not parse again: each edge takes the probability of its rule.
+        The two forests share their structure (nodes, edges and topological order).
+        """
+        return self.reweight(grammar.probs[self.grammar_rule_ids()])
+
+    def incoming_edges(self, node):
+        """ids of the edges whose head is the node"""
+        return self._incoming_edges.get(node, ())
+
+    def topological_order(self, root=None):
+        """
+        Return nodes in bottom-up order: the children of a node always come before it.
+
+        The order is computed once (per root) and cached until edges are added.
+
+        :param root: if given, only nodes reachable from it (top-down) are returned, otherwise all nodes
+        :returns: a list of nodes
+        :raises ValueError: if the forest has a cycle (e.g. from unary rules S -> A and A -> S)
+        """
+        order = self._topological.get(root, None)
+        if order is not None:
+            return order
+        order = []
+        visited = [False] * len(self._nodes)
+        on_stack = [False] * len(self._nodes)  # nodes on the current path: reaching one closes a cycle
+        roots = range(len(self._nodes)) if root is None else [root]
+        for r in roots:
+            if visited[r]:
+                continue
+            visited[r] = on_stack[r] = True
+            # an explicit stack of (node, iterator over children) gives us a post-order without recursion
+            stack = [(r, iter(self._children(r)))]
+            while stack:
+                node, children = stack[-1]
+                for child in children:
+                    if on_stack[child]:
+                        raise ValueError('I have a cycle through %s' % self.render_symbol(child))
+                    if not visited[child]:
+                        visited[child] = on_stack[child] = True
+                        stack.append((child, iter(self._children(child))))
+                        break
+                else:
+                    stack.pop()
+                    on_stack[node] = False
+                    order.append(node)
+        self._topological[root] = order
+        return order
+
+    def _children(self, node):
+        for rule in self._rules_by_lhs.get(node, ()):
+            for child in rule.rhs:
+                yield child
+
+    def make_node(self, sym_id, start, end):
+        """return the node for the triple (sym_id, start, end), creating it if necessary"""
+        key = (sym_id, start, end)
+        node = self._node_ids.get(key, None)
+        if node is None:
+            node = len(self._nodes)
+            self._node_ids[key] = node
+            self._nodes.append(key)
+        return node
+
+    def node(self, symbol, start, end):
+        """return the node of a grammar symbol (str) spanning from `start` to `end`"""
+        return self.make_node(self._vocab[symbol], start, end)
+
+    def triple(self, node):
+        """return the triple (sym_id, start, end) of a node"""
+        return self._nodes[node]
+
+    def base(self, node):
+        """return the grammar symbol (str) of a node"""
+        return self._vocab.symbol(self._nodes[node][0])
+
+    def is_terminal(self, node):
+        return self._vocab.is_terminal(self._nodes[node][0])
+
+    def num_nodes(self):
+        return len(self._nodes)
+
+    def render_symbol(self, node):
+        """format a node as in [S:0-5] (terminals are formatted as themselves)"""
+        sym_id, start, end = self._nodes[node]
+        return make_symbol(self._vocab.symbol(sym_id), start, end)
+
+    def render_rule(self, rule):
+        """return a copy of an edge whose symbols are formatted strings"""
+        return Rule(self.render_symbol(rule.lhs), [self.render_symbol(s) for s in rule.rhs], self.prob(rule))
+
+    def render(self):
+        """return a WCFG where nodes are formatted as strings"""
+        return WCFG(self.render_rule(rule) for rule in self)
+
+    def __str__(self):
+        return '\n'.join(str(self.render_rule(rule)) for rule in self)
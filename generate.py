@@ -2,11 +2,146 @@
 Functions to generate corpora from PCFGs (in WCFG form),
 and to generate rule probabilites for a CFG using a Dirichlet 
 distribution.
+
+Sentences are drawn by a Generator, which compiles the grammar once into an alias table
+per nonterminal (Walker, 1977; Vose, 1991) so that choosing a rule costs one random number
+and no search, whatever the number of rules. A derivation is expanded with an explicit
+stack, not by recursion, thus deep derivations are fine.
 """
-from rule import Rule
 import numpy as np
 from symbol import is_nonterminal
 
+
+def alias_table(ps):
+    """
+    Vose's alias method.
+
+    :param ps: probabilities (normalised here)
+    :returns: (accept, alias), two lists such that, for u uniform in [0, 1),
+        i = int(u * n) is chosen if u * n - i < accept[i] and alias[i] is chosen otherwise
+    """
+    n = len(ps)
+    scaled = np.asarray(ps, dtype=float)
+    scaled = scaled * (n / scaled.sum())
+    accept = [1.0] * n
+    alias = list(range(n))
+    small = [i for i in range(n) if scaled[i] < 1.0]
+    large = [i for i in range(n) if scaled[i] >= 1.0]
+    while small and large:
+        s, l = small.pop(), large.pop()
+        accept[s] = scaled[s]
+        alias[s] = l
+        # l gives away the mass that fills the column of s
+        scaled[l] -= 1.0 - scaled[s]
+        if scaled[l] < 1.0:
+            small.append(l)
+        else:
+            large.append(l)
+    # what is left is (up to rounding) exactly full
+    return accept, alias
+
+
+class Generator(object):
+
+    def __init__(self, grammar, max_length=None, max_depth=None, buffer_size=4096, rng=None, max_attempts=10000):
+        """
+        Compile a grammar for sampling.
+
+        :param grammar: a WCFG (the probabilities of the rules of a nonterminal are normalised)
+        :param max_length: if given, a derivation is abandoned as soon as it yields more terminals
+        :param max_depth: if given, a derivation is abandoned as soon as it is deeper
+            (a nonterminal rewritten by the start symbol has depth 2)
+        :param buffer_size: how many random numbers we draw at once
+        :param rng: a numpy RandomState (by default numpy's global one)
+        :param max_attempts: how many derivations we draw for a sentence before giving up
+
+        With guards, abandoned derivations are drawn again: sentences then come from the
+        distribution of the grammar conditioned on the guards (see `rejected`).
+        Guards that (almost) no derivation meets raise a ValueError after max_attempts.
+        """
+        self._max_length = max_length
+        self._max_depth = max_depth
+        self._buffer_size = buffer_size
+        self._max_attempts = max_attempts
+        self._rng = np.random if rng is None else rng
+        self._buffer = []
+        self._next = 0
+        self._rejected = 0
+        # nonterminal -> (accept, alias, RHS of its rules reversed as they go on the stack)
+        self._tables = dict()
+        for nonterminal in grammar.nonterminals:
+            rules = list(grammar.get(nonterminal))
+            if not rules:
+                continue
+            accept, alias = alias_table([grammar.prob(rule) for rule in rules])
+            rhss = [tuple((sym, is_nonterminal(sym)) for sym in reversed(rule.rhs)) for rule in rules]
+            self._tables[nonterminal] = (accept, alias, rhss)
+
+    @property
+    def rejected(self):
+        """how many derivations have been abandoned by the guards so far"""
+        return self._rejected
+
+    def _uniform(self):
+        if self._next == len(self._buffer):
+            self._buffer = self._rng.random_sample(self._buffer_size).tolist()
+            self._next = 0
+        u = self._buffer[self._next]
+        self._next += 1
+        return u
+
+    def _derive(self, items):
+        """a sentence (list) or None if a guard abandoned the derivation"""
+        max_length, max_depth = self._max_length, self._max_depth
+        tables = self._tables
+        sentence = []
+        stack = [(item, is_nonterminal(item), 1) for item in reversed(items)]
+        while stack:
+            sym, nonterminal, depth = stack.pop()
+            if not nonterminal:
+                sentence.append(sym)
+                if max_length is not None and len(sentence) > max_length:
+                    return None
+                continue
+            if max_depth is not None and depth > max_depth:
+                return None
+            table = tables.get(sym, None)
+            if table is None:
+                raise ValueError('I have no rules for %s' % sym)
+            accept, alias, rhss = table
+            x = self._uniform() * len(accept)
+            i = int(x)
+            if x - i >= accept[i]:
+                i = alias[i]
+            depth += 1
+            stack.extend((child, child_is_nonterminal, depth) for child, child_is_nonterminal in rhss[i])
+        return sentence
+
+    def sample(self, items=('[E]',)):
+        """
+        A sentence.
+
+        :param items: the symbols to expand, e.g. (start,)
+        :returns: a list of terminals
+        :raises ValueError: if the guards abandoned max_attempts derivations in a row
+        """
+        for _ in range(self._max_attempts):
+            sentence = self._derive(items)
+            if sentence is not None:
+                return sentence
+            self._rejected += 1
+        raise ValueError('I gave up after %d derivations of %s: the guards (max_length=%s, max_depth=%s) '
+                         'abandoned all of them' % (self._max_attempts, ' '.join(items),
+                                                    self._max_length, self._max_depth))
+
+    def stream(self, n=None, items=('[E]',)):
+        """iterator over n sentences (or endless, if n is None)"""
+        count = 0
+        while n is None or count < n:
+            yield self.sample(items)
+            count += 1
+
+
 def generate_sample(grammar, items=('[E]',)):
     """
     Given a grammar returns a sentence from it using
@@ -14,29 +149,23 @@ def generate_sample(grammar, items=('[E]',)):
     :param items: call the function with (start,) where 
                   start is the start symbol of the grammar
     :returns: a sentence from the language as a list
+
+    Each call compiles the grammar (and draws a buffer of random numbers) anew,
+    which costs far more than the sentence: to draw many, use a Generator (or generate_corpus).
     """
-    frags = []
-    for item in items:
-        if is_nonterminal(item):
-            productions = grammar.get(item)
-            ps = [production.prob for production in productions]
-            random_index = np.argmax(np.random.multinomial(1, ps, size=1))
-            prod = productions[random_index]
-            frags.extend(generate_sample(grammar, items=prod.rhs))
-        else:
-            frags.append(item)
-    return frags
+    return Generator(grammar, buffer_size=64).sample(items)
 
 # print generate_sample(G)
 
-def generate_corpus(grammar, n, start=('[E]',),):
+def generate_corpus(grammar, n, start=('[E]',), max_length=None, max_depth=None):
     """
     Generates a corpus using the grammar
     :param n: size of the corpus
     :params: same a s generate corpus
+    :param max_length, max_depth: guards (see Generator)
     :returns: a corpus in the form of a list
     """
-    return [generate_sample(grammar, items=start) for i in range(n)]
+    return list(Generator(grammar, max_length, max_depth).stream(n, start))
 
 # corpus1 = generate_corpus(G, 100)
 # corpus2 = generate_corpus(G, 1000)
@@ -51,13 +180,14 @@ def initialize(grammar, alpha=20.0):
     generated from a Dirichlet distribution.
     :param: alpha is the Dirichlet concentration parameter
     """
-    init_grammar = WCFG()
+    init_probs = np.zeros(len(grammar))
     for nonterminal in grammar.nonterminals:
         rules = grammar.get(nonterminal)
         init_prob = np.random.dirichlet(len(rules)*[alpha])
         for i, rule in enumerate(rules):
-            init_grammar.add(Rule(rule.lhs, rule.rhs, init_prob[i]))
-    return init_grammar
+            init_probs[grammar.rule_id(rule)] = init_prob[i]
+    # the initialized grammar shares the rules of grammar, only the probabilities are new
+    return grammar.reweight(init_probs)
 
 # init_grammar = initialize(G)
 # print init_grammar
@@ -1,149 +1,414 @@
 import numpy as np
+import multiprocessing
+from math import lgamma
 import matplotlib.pyplot as plt
 from rule import Rule
 from cfg import WCFG, read_grammar_rules
 from parser import cky
 from earley import earley
-from symbol import make_symbol, is_nonterminal, is_terminal
 from collections import defaultdict
-from util import get_rules_by_rhs
+from itertools import islice
+from cache import ForestCache
+from corpus import WeightedCorpus, weighted
+from semiring import Probability, LogProbability, inside_values, outside_values
 
 
 
-def inside(forest, start):  # acyclic hypergraph
+def inside(forest, start, semiring=Probability):  # acyclic hypergraph
     """
     The inside recursion for acyclic hypergraphs.
+
+    Nodes are visited bottom-up in the topological order of the forest (see semiring.inside_values).
     
-    :param forest: an acyclic WCFG
-    :param start: the start symbol (str)
+    :param forest: a Forest
+    :param start: the start symbol (a node of the forest)
+    :param semiring: Probability by default, use LogProbability for long sentences
     :returns: a dictionary mapping a symbol (terminal or noterminal) to its inside weight
     """
-    I = dict()
-    
-    def get_inside(symbol):
-        """computes inside recursively"""
-        w = I.get(symbol, None)
-        if w is not None:  # already computed
-            return w
-        incoming = forest.get(symbol, set())
-        if len(incoming) == 0:  # terminals have already been handled, this must be a nonterminal dead end
-            # store it to avoid repeating computation in the future
-            I[symbol] = 0.0
-            return 0.0
-        # accumulate the inside contribution of each incoming edge
-        w = 0.0
-        for rule in incoming:
-            k = rule.prob
-            for child in rule.rhs:
-                k *= get_inside(child)
-            w += k
-        # store it to avoid repeating computation in the future
-        I[symbol] = w
-        return w
-    
-    # handles terminals
+    values, _ = inside_values(forest, semiring, start)
+    I = dict((node, values[node]) for node in forest.topological_order(start))
+    # handles terminals (also those not under the start symbol)
     for sym in forest.terminals:
-        I[sym] = 1.0
-    # recursively solves the inside formula from the start symbol
-    get_inside(start)
-        
+        I[sym] = semiring.one
     return I
 
- def outside(forest, start, inside_dict):
-    
-    I = dict()
-    
-    def get_outside(symbol):
-        w = I.get(symbol, None)
-        if w is not None:  # already computed
-            return w
-        outgoing = get_rules_by_rhs(forest, symbol)
-        beta = 0.0
-        for rule in outgoing:
-            k = rule.prob
-            for child in rule.rhs:
-                if child != symbol:
-                    try:
-                        alpha = inside_dict[child]
-                    except KeyError:
-                        # Not sure about this solution...
-                        # If child is not in inside_dict then child was not seen in the top-down process
-                        # of the inside algorithm, and hence there is no way to complete child into a 
-                        # parse for the whole sentence. So beta should be 0.0
-#                         print "key-error with {}".format(child)
-                        alpha = 0.0
-                    k *= alpha
-            k *= get_outside(rule.lhs)
-            beta += k
-        I[symbol] = beta
-        return beta
-    
-    I[start] = 1.0
-    
-    for sym in forest.terminals:
-#         print "terminal: {}".format(sym)
-        I[sym] = get_outside(sym)
-    
-    return I
+def outside(forest, start, inside_dict, semiring=Probability):
+    """
+    The outside recursion for acyclic hypergraphs.
+
+    Nodes are visited top-down (in reverse topological order) and each node passes
+    its outside weight on to the children of its incoming edges (see semiring.outside_values).
+
+    :param forest: a Forest
+    :param start: the start symbol (a node of the forest)
+    :param inside_dict: inside weights as computed by `inside`
+        (a node missing from it could not be reached from the start symbol, and weighs zero)
+    :param semiring: the semiring of inside_dict
+    :returns: a dictionary mapping a symbol (terminal or noterminal) to its outside weight
+    """
+    W = [inside_dict.get(node, semiring.zero) for node in range(forest.num_nodes())]
+    O = outside_values(forest, semiring, W, start)
+    return dict(enumerate(O))
+
+
+def expected_counts(forest, goal, grammar):
+    """
+    The E-step for a single sentence.
+
+    The outside pass gives us the total probability of the derivations through each edge
+    (see semiring.outside_values), which we add up by the grammar rule of the edge.
+
+    :param forest: the Forest of the sentence (with the probabilities of `grammar`)
+    :param goal: its goal node
+    :param grammar: the WCFG we parsed with
+    :returns: a vector with the expected number of times each rule is used
+        in a derivation of the sentence (indexed by rule id)
+    :raises ValueError: if the sentence has no derivation (we would divide by zero)
+    """
+    counts, _ = _expected_counts(forest, goal, grammar)
+    return counts
 
+def _expected_counts(forest, goal, grammar):
+    """expected rule counts (see expected_counts) and the inside weight of the goal node"""
+    I, _ = inside_values(forest, Probability, goal)
+    if I[goal] <= 0.0:
+        raise ValueError('the sentence has no derivation')
+    totals = [0.0] * len(forest)
+    outside_values(forest, Probability, I, goal, edge_totals=totals)
+    return np.bincount(forest.grammar_rule_ids(), weights=totals, minlength=len(grammar)) / I[goal], I[goal]
 
-def inside_outside(training_sents, grammar, start_sym='[E]'):
-    f = defaultdict(float)
-    for sent in training_sents:
-        forest = cky(grammar, sent)
-        goal = make_symbol(start_sym, 0, len(sent))
-        I = inside(forest, goal)
-        O = outside(forest, goal, I)     
-        for rule in grammar:
-            w = 0.0
-            for instance in get_instances(rule, forest):
-                k = rule.prob
-                k *= O[instance.lhs]
-                for child in instance.rhs:
-                    try:
-                        alpha = I[child]
-                    except KeyError:
-                        # same solution as in outside
-                        alpha = 0.0
-                    k *= alpha
-                w += k
-            f[rule] += w/I[goal]
+# the state of a worker process (see _init_estep_worker)
+_estep_grammar = None
+_estep_start_sym = None
+_estep_corpus = None
+_estep_cache = None
+
+def _init_estep_worker(grammar, start_sym, corpus, cache):
+    """each worker receives the grammar and the corpus once, when the pool starts (tasks carry probabilities)"""
+    global _estep_grammar, _estep_start_sym, _estep_corpus, _estep_cache
+    _estep_grammar = grammar
+    _estep_start_sym = start_sym
+    _estep_corpus = corpus
+    _estep_cache = cache
+
+def _estep_shard(task):
+    """
+    Expected counts and log-likelihood of a shard of distinct sentences, summed in order
+    and scaled by their counts.
+
+    A task is (indices, probs, sentences): indices into the corpus of the worker, or into
+    `sentences` (a WeightedCorpus) if the task carries its own sentences.
+    """
+    indices, probs, sentences = task
+    grammar = _estep_grammar.reweight(probs)
+    corpus = _estep_corpus if sentences is None else sentences
+    f = np.zeros(len(grammar))
+    loglik = 0.0
+    for i in indices:
+        if sentences is None and _estep_cache is not None:
+            forest, goal = _estep_cache.forest(i, grammar), _estep_cache.goal(i)
+        else:
+            sent = corpus.sentence(i)
+            forest = cky(grammar, sent)
+            goal = forest.node(_estep_start_sym, 0, len(sent))
+        try:
+            counts, Z = _expected_counts(forest, goal, grammar)
+        except ValueError:
+            raise ValueError('I cannot parse sentence %d: %s' % (i, ' '.join(corpus.sentence(i))))
+        f += corpus.count(i) * counts
+        loglik += corpus.count(i) * np.log(Z)
+    return f, loglik
+
+def _estep_pool(grammar, start_sym, workers, cache=None, shard_size=16):
+    """
+    A pool of workers for many E-steps with the rules of grammar, or None if we run in this process.
+
+    The workers receive the rules (and the forests of cache, if given) once, thus all the
+    E-steps of a run share the pool: each task only carries the current probabilities
+    and, without a cache, its sentences (see inside_outside).
+    """
+    if workers <= 1:
+        return None
+    if cache is None:
+        return multiprocessing.Pool(workers, _init_estep_worker, (grammar, start_sym, None, None))
+    if len(cache.corpus) > shard_size:
+        return multiprocessing.Pool(workers, _init_estep_worker, (grammar, start_sym, cache.corpus, cache))
+    return None
+
+def inside_outside(training_sents, grammar, start_sym='[E]', workers=1, shard_size=16, cache=None, pool=None,
+                   with_likelihood=False):
+    """
+    The E-step: expected rule counts over a corpus.
+
+    Repeated sentences are processed once, their expected counts are scaled by how many times
+    they occur. The distinct sentences are split into shards of `shard_size` consecutive sentences.
+    Each shard is summed in order, and the shard totals are summed in order, whatever the number
+    of workers: thus the result of a parallel E-step is identical to that of a serial one.
+
+    :param training_sents: a list of sentences or a WeightedCorpus
+    :param grammar: a WCFG
+    :param start_sym: the start symbol
+    :param workers: number of worker processes (1 runs in this process)
+    :param shard_size: number of sentences per shard
+    :param cache: a ForestCache of training_sents parsed with the rules of grammar,
+        if given we reweight its forests instead of parsing
+    :param pool: a pool of workers started with the rules of grammar (and with cache, if given,
+        see _estep_pool), which we send the probabilities of grammar (and, without a cache,
+        the sentences of each shard); if given, `workers` is ignored
+    :param with_likelihood: if True we also return the log-likelihood of the corpus, which
+        comes for free with the inside weights of the E-step (see log_likelihood)
+    :returns: a vector of expected counts indexed by rule id
+        (and the log-likelihood, if with_likelihood)
+    :raises ValueError: if a sentence has no derivation
+    """
+    corpus = cache.corpus if cache is not None else weighted(training_sents)
+    shards = [range(i, min(i + shard_size, len(corpus))) for i in range(0, len(corpus), shard_size)]
+    tasks = [(shard, grammar.probs, None) for shard in shards]
+    if pool is not None and len(shards) > 1:
+        if cache is None:  # the workers have the rules alone
+            tasks = [(range(len(shard)), grammar.probs,
+                      WeightedCorpus.from_counts((corpus.sentence(i), corpus.count(i)) for i in shard))
+                     for shard in shards]
+        totals = pool.map(_estep_shard, tasks)
+    elif workers > 1 and len(shards) > 1:
+        pool = multiprocessing.Pool(workers, _init_estep_worker, (grammar, start_sym, corpus, cache))
+        try:
+            totals = pool.map(_estep_shard, tasks)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        _init_estep_worker(grammar, start_sym, corpus, cache)
+        totals = [_estep_shard(task) for task in tasks]
+    f = np.zeros(len(grammar))
+    loglik = 0.0
+    for total, shard_loglik in totals:
+        f += total
+        loglik += shard_loglik
+    if with_likelihood:
+        return f, loglik
     return f
 
-def EM(training_sents, grammar, n, start_sym='[E]', prin=False):
+def log_likelihood(training_sents, grammar, start_sym='[E]', cache=None):
+    """
+    The log-likelihood of a corpus, sum_x log p(x), where repeated sentences are parsed once.
+
+    :param training_sents: a list of sentences or a WeightedCorpus
+    :param grammar: a WCFG
+    :param start_sym: the start symbol
+    :param cache: a ForestCache of training_sents parsed with the rules of grammar
+    :returns: a float (-inf if some sentence has no derivation)
+    """
+    if cache is None:
+        cache = ForestCache(grammar, training_sents, start_sym)
+    total = 0.0
+    for i, (forest, goal) in enumerate(cache.forests(grammar)):
+        I = inside(forest, goal, LogProbability)
+        total += cache.count(i) * I[goal]
+    return total
+
+def EM(training_sents, grammar, n, start_sym='[E]', prin=False, workers=1, cache=None):
     if prin == True:
         print "Initalized grammar:\n{}\n".format(grammar)
-    step = 0
-    while step < n:
-        
-        # E-step
-        f = inside_outside(training_sents, grammar, start_sym=start_sym)
-                
-        #M-step
-        new_grammar = WCFG()
-        for rule in grammar:
-            new_prob = f[rule]/sum([f[r] for r in grammar.get(rule.lhs)])
-            new_grammar.add(Rule(rule.lhs, rule.rhs, new_prob))
-        
-        grammar = new_grammar
-        
-        step +=1   
+    if cache is None:
+        # the rules never change, only their probabilities: we parse once and reweight the forests
+        cache = ForestCache(grammar, training_sents, start_sym)
+    # the workers receive the forests once, each iteration sends them the new probabilities
+    pool = _estep_pool(grammar, start_sym, workers, cache)
+    try:
+        step = 0
+        while step < n:
+
+            # E-step
+            f = inside_outside(training_sents, grammar, start_sym=start_sym, cache=cache, pool=pool)
+
+            #M-step: the rules (and their ids) stay the same, only the probability vector changes
+            grammar = grammar.reweight(grammar.normalize(f))
+
+            step +=1
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
     return grammar
 
 
+def stepwise_EM(sentences, grammar, start_sym='[E]', batch_size=100, alpha=0.7, workers=1):
+    """
+    Online EM (stepwise EM, Liang & Klein, 2009).
+
+    Sentences are read from an iterator in mini-batches and the grammar is updated after each
+    batch, thus we never hold more than a batch in memory. We keep running sufficient statistics
+    mu (expected rule counts per sentence) and, after the k-th batch (k = 0, 1, ...), interpolate
+    them with the expected counts s_k of the batch:
+
+        mu = (1 - eta_k) mu + eta_k s_k    where eta_k = (k + 2)^-alpha
+
+    The new probabilities are mu normalised by LHS (as in the M-step of EM).
+
+    :param sentences: an iterable of sentences (possibly endless, e.g. Generator.stream())
+    :param grammar: the initial WCFG
+    :param start_sym: the start symbol
+    :param batch_size: number of sentences per batch
+    :param alpha: the decay of the step size, in (0.5, 1] (1 is close to batch EM
+        for a single pass, smaller values forget old batches faster)
+    :param workers: number of worker processes for the E-step of a batch (the pool lives for
+        all batches: it is closed when the iterator is exhausted or closed)
+    :returns: an iterator over the grammars after each batch
+    """
+    sentences = iter(sentences)
+    mu = np.zeros(len(grammar))
+    k = 0
+    # the workers receive the rules once, each batch sends them its sentences and the new probabilities
+    pool = _estep_pool(grammar, start_sym, workers)
+    try:
+        while True:
+            batch = list(islice(sentences, batch_size))
+            if not batch:
+                break
+            s = inside_outside(batch, grammar, start_sym=start_sym, pool=pool) / len(batch)
+            eta = (k + 2) ** -alpha
+            mu = (1.0 - eta) * mu + eta * s
+            grammar = grammar.reweight(grammar.normalize(mu))
+            k += 1
+            yield grammar
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+
+def digamma(x):
+    """
+    The digamma function (the derivative of log Gamma) of a vector of positive numbers.
+
+    We shift every x to x + k >= 6 with psi(x) = psi(x + 1) - 1/x and use the asymptotic series there.
+    """
+    x = np.array(x, dtype=float)
+    result = np.zeros(x.shape)
+    for _ in range(6):
+        small = x < 6.0
+        result[small] -= 1.0 / x[small]
+        x[small] += 1.0
+    r = 1.0 / (x * x)
+    return result + np.log(x) - 0.5 / x - r * (1.0/12 - r * (1.0/120 - r * (1.0/252 - r * (1.0/240 - r / 132))))
+
+def variational_weights(grammar, betas):
+    """
+    The weights of the variational grammar, exp(E[log theta_R]) under q(theta_A) = Dirichlet(beta_A):
+
+        W_R = exp(psi(beta_R) - psi(sum of beta_R' over the rules R' of the LHS of R))
+
+    (they sum to less than one per LHS).
+    """
+    _, index = grammar.lhs_index()
+    totals = np.bincount(index, weights=betas)[index]
+    return np.exp(digamma(betas) - digamma(totals))
+
+def dirichlet_kl(grammar, betas, alphas):
+    """sum over LHS A of KL(Dirichlet(beta_A) || Dirichlet(alpha_A))"""
+    _, index = grammar.lhs_index()
+    log_gamma = lambda v: np.array([lgamma(x) for x in np.asarray(v, dtype=float).tolist()])
+    beta_A = np.bincount(index, weights=betas)
+    alpha_A = np.bincount(index, weights=alphas)
+    return (log_gamma(beta_A).sum() - log_gamma(alpha_A).sum() - log_gamma(betas).sum() + log_gamma(alphas).sum()
+            + ((betas - alphas) * (digamma(betas) - digamma(beta_A)[index])).sum())
+
+def stick_breaking_weights(K, gamma=1.0):
+    """
+    The mean of a GEM(gamma) stick truncated to K pieces: the k-th piece takes a fraction
+    1 / (1 + gamma) of what is left of the stick, and the last piece takes the rest.
+    """
+    v = np.ones(K) / (1.0 + gamma)
+    v[-1] = 1.0
+    left = np.concatenate([[1.0], np.cumprod(1.0 - v[:-1])])
+    return v * left
+
+def hdp_pseudocounts(grammar, alpha=1.0, gamma=1.0):
+    """
+    Dirichlet pseudocounts of a truncated HDP-PCFG (Liang et al., 2007).
+
+    The nonterminals of the grammar are the K states of the truncation, in the order in
+    which they first occur as a LHS. A state k has a top-level weight b_k drawn from a
+    stick (we use the mean of a truncated GEM(gamma)), and the pseudocount of a rule is
+    alpha times the product of the weights of the nonterminals of its RHS (lexical rules
+    get alpha): rules that use states far down the stick are a priori unlikely, thus
+    VB switches off the states the data does not need.
+
+    :returns: a vector of pseudocounts indexed by rule id
+    """
+    lhs, _ = grammar.lhs_index()
+    rank = dict((A, k) for k, A in enumerate(lhs))
+    for rule in grammar:
+        for sym in rule.rhs:
+            if grammar.is_nonterminal(sym) and sym not in rank:
+                rank[sym] = len(rank)
+    b = stick_breaking_weights(len(rank), gamma)
+    alphas = np.zeros(len(grammar))
+    for rule in grammar:
+        alphas[grammar.rule_id(rule)] = alpha * np.prod([b[rank[sym]] for sym in rule.rhs if sym in rank])
+    return alphas
+
+def VB(training_sents, grammar, n, start_sym='[E]', alpha=1.0, tol=None, workers=1, cache=None):
+    """
+    Mean-field variational Bayes (Kurihara & Sato, 2006): q(theta) q(trees), with a Dirichlet
+    prior on the rules of each LHS.
+
+    Each iteration runs the E-step of EM with the variational weights of the current
+    q(theta_A) = Dirichlet(beta_A) (see variational_weights) and sets beta = alpha + expected counts.
+    The evidence lower bound of q(theta) is
+
+        ELBO = sum_x log Z_x(W) - KL(q(theta) || p(theta))
+
+    where Z_x(W) is the inside weight of sentence x under the variational weights.
+
+    :param training_sents: a list of sentences or a WeightedCorpus
+    :param grammar: a WCFG, its probabilities are the weights of the first E-step
+    :param n: maximum number of iterations
+    :param alpha: the Dirichlet pseudocounts, a number or a vector indexed by rule id
+        (e.g. hdp_pseudocounts(grammar))
+    :param tol: if given, we stop once the ELBO improves by less than tol (relative)
+    :param workers: number of worker processes (the pool lives for all iterations)
+    :param cache: a ForestCache of training_sents parsed with the rules of grammar
+    :returns: (the grammar of the posterior means, the ELBO after each iteration but the first)
+    """
+    if cache is None:
+        cache = ForestCache(grammar, training_sents, start_sym)
+    alphas = np.zeros(len(grammar)) + alpha
+    weights = grammar.probs
+    betas = None
+    elbos = []
+    pool = _estep_pool(grammar, start_sym, workers, cache)
+    try:
+        for step in range(n):
+            variational = grammar.reweight(weights)
+            # the E-step also sums up log Z_x(W) for the ELBO
+            f, loglik = inside_outside(training_sents, variational, start_sym=start_sym, cache=cache, pool=pool,
+                                       with_likelihood=True)
+            if betas is not None:
+                elbos.append(loglik - dirichlet_kl(grammar, betas, alphas))
+                if tol is not None and len(elbos) > 1 and abs(elbos[-1] - elbos[-2]) < tol * abs(elbos[-2]):
+                    break
+            betas = alphas + f
+            weights = variational_weights(grammar, betas)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    return grammar.reweight(grammar.normalize(betas)), elbos
+
+
 def plot_EM(corpus, grammar, n, start_sym='[E]'):
     d = defaultdict(list)
     for rule in grammar:
-        # make sure the dict entries do not depend on the rule probs
-        ruled = Rule(rule.lhs, rule.rhs, 1.0)
-        d[ruled].append(rule.prob)
+        # rules are identified regardless of their probs
+        d[rule].append(grammar.prob(rule))
     i = 0
     while i < n:
         print "round {}".format(i)
         new_grammar = EM(corpus1, grammar, 1, start_sym=start_sym, prin=False)
         for rule in new_grammar:
-            ruled = Rule(rule.lhs, rule.rhs, 1.0)
-            d[ruled].append(rule.prob)
+            d[rule].append(new_grammar.prob(rule))
        
         grammar = new_grammar
         i += 1
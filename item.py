@@ -3,59 +3,89 @@ An item in a CKY/Earley program.
 """
 
 class Item(object):
-    """A dotted rule used in CKY/Earley."""
-    
-    def __init__(self, rule, dots):
-        assert len(dots) > 0, 'I do not accept an empty list of dots'
+    """
+    A dotted rule used in CKY/Earley.
+
+    An item [X -> alpha * beta, i, j] is identified by its rule, by how many RHS symbols
+    are to the left of the dot (len(alpha)) and by the positions i and j. The positions in
+    between (where each symbol in alpha starts and ends) are not part of the item: the agenda
+    keeps them as back-pointers (see Agenda.states), so that an item derived in many ways
+    is stored only once.
+    """
+
+    # an agenda may hold millions of items: no __dict__, and a hash computed only once
+    __slots__ = ('rule_', 'pos_', 'start_', 'dot_', 'split_', 'hash_')
+
+    def __init__(self, rule, start, dot=None, pos=0, split=None):
+        """
+        :param rule: a Rule
+        :param start: where the item starts (i)
+        :param dot: where the item ends (j), by default i
+        :param pos: how many RHS symbols are to the left of the dot
+        :param split: the back-pointer of a new item, i.e. the dot of the item we advanced
+        """
         self.rule_ = rule
-        self.dots_ = tuple(dots)
-        
+        self.pos_ = pos
+        self.start_ = start
+        self.dot_ = start if dot is None else dot
+        self.split_ = split
+        self.hash_ = hash((rule, pos, start, self.dot_))
+
     def __eq__(self, other):
-        return self.rule_ == other.rule_ and self.dots_ == other.dots_
-    
+        return (self.hash_ == other.hash_ and self.pos_ == other.pos_ and self.start_ == other.start_
+                and self.dot_ == other.dot_ and self.rule_ == other.rule_)
+
     def __ne__(self, other):
         return not(self == other)
-    
+
     def __hash__(self):
-        return hash((self.rule_, self.dots_))
-    
+        return self.hash_
+
     def __repr__(self):
-        return '{0} ||| {1}'.format(self.rule_, self.dots_)
-    
+        return '{0} ||| {1} ||| {2}'.format(self.rule_, self.pos_, (self.start_, self.dot_))
+
     def __str__(self):
-        return '{0} ||| {1}'.format(self.rule_, self.dots_)
-    
+        return '{0} ||| {1} ||| {2}'.format(self.rule_, self.pos_, (self.start_, self.dot_))
+
     @property
     def lhs(self):
         return self.rule_.lhs
-    
+
     @property
     def rule(self):
         return self.rule_
-    
+
     @property
     def dot(self):
-        return self.dots_[-1]
-    
+        return self.dot_
+
     @property
     def start(self):
-        return self.dots_[0]
-    
+        return self.start_
+
+    @property
+    def pos(self):
+        return self.pos_
+
+    @property
+    def split(self):
+        return self.split_
+
     @property
     def next(self):
         """return the symbol to the right of the dot (or None, if the item is complete)"""
         if self.is_complete():
             return None
-        return self.rule_.rhs[len(self.dots_) - 1]
-    
-    def state(self, i):
-        return self.dots_[i]
+        return self.rule_.rhs[self.pos_]
 
     def advance(self, dot):
-        """return a new item with an extended sequence of dots"""
-        return Item(self.rule_, self.dots_ + (dot,))
-    
+        """return a new item whose dot moved over the next symbol, which ends at `dot`"""
+        return Item(self.rule_, self.start_, dot, self.pos_ + 1, self.dot_)
+
+    def retreat(self, split):
+        """return the item this item was advanced from, given where it ended (a back-pointer)"""
+        return Item(self.rule_, self.start_, split, self.pos_ - 1)
+
     def is_complete(self):
         """complete items are those whose dot reached the end of the RHS sequence"""
-        return len(self.rule_.rhs) + 1 == len(self.dots_)    
-    
\ No newline at end of file
+        return len(self.rule_.rhs) == self.pos_
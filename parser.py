@@ -1,26 +1,34 @@
 from cfg import read_grammar_rules, WCFG
 from rule import Rule
-from symbol import is_terminal, is_nonterminal, make_symbol
+from forest import Forest
 from collections import defaultdict
 from item import Item
 from agenda import Agenda
 
-def cky_axioms(cfg, sentence):
+def cky_axioms(cfg, sentence, stats=None):
     """
     Axioms for CKY.
     
     Inference rule:
-        -------------------- (X -> alpha) in cfg and 0 <= i < n
-        [X -> * alpha, [i]]
+        -------------------- (X -> alpha) in cfg and 0 <= i < n and alpha =>* sentence[i] beta
+        [X -> * alpha, i, i]
+
+    An item whose RHS cannot derive a string starting with the word at position i would
+    never be completed, thus we only seed rules indexed by that word (see WCFG.starting_with).
     
-    :param cfg: a context-free grammar (an instance of WCFG)
-    :param sentence: the input sentence (as a list or tuple)
+    :param cfg: a context-free grammar (an instance of InternedWCFG)
+    :param sentence: the input sentence (as a list or tuple of terminal ids)
+    :param stats: if given, a dictionary where we count 'axioms' and 'avoided' items
+        (those we would have seeded without the index)
     :returns: a list of items
     """
     items = []
-    for rule in cfg:
-        for i in range(len(sentence)):  # from zero to n-1
-            items.append(Item(rule, [i]))
+    for i, word in enumerate(sentence):  # from zero to n-1
+        for rule in cfg.starting_with(word):
+            items.append(Item(rule, i))
+    if stats is not None:
+        stats['axioms'] = stats.get('axioms', 0) + len(items)
+        stats['avoided'] = stats.get('avoided', 0) + len(cfg) * len(sentence) - len(items)
     return items
 
 def scan(item, sentence):
@@ -29,15 +37,14 @@ def scan(item, sentence):
     
     Inference rule:
     
-        [X -> alpha * x beta, [i ... j]]
+        [X -> alpha * x beta, i, j]
         ------------------------------------    sentence[j] == x
-        [X -> alpha x * beta, [i ... j + 1]]
+        [X -> alpha x * beta, i, j + 1]
     
-    :param item: an active Item
-    :param sentence: a list/tuple of terminals
+    :param item: an active Item whose next symbol is a terminal
+    :param sentence: a list/tuple of terminal ids
     :returns: an Item or None
     """
-    assert is_terminal(item.next), 'Only terminal symbols can be scanned, got %s' % item.next
     if item.dot < len(sentence) and sentence[item.dot] == item.next:
         return item.advance(item.dot + 1)
     else:
@@ -49,9 +56,9 @@ def complete(item, agenda):
     
     Inference rule:
     
-        [X -> alpha * Y beta, [i ... k]] [Y -> gamma *, [k ... j]]
-        ----------------------------------------------------------
-                 [X -> alpha Y * beta, [i ... j]]
+        [X -> alpha * Y beta, i, k] [Y -> gamma *, k, j]
+        ------------------------------------------------
+                 [X -> alpha Y * beta, i, j]
                  
     :param item: an active Item.
         if `item` is complete, we advance the dot of incomplete passive items to `item.dot`
@@ -75,43 +82,65 @@ def complete(item, agenda):
             items.append(item.advance(end))
     return items
 
-def make_forest(complete_items):
+def make_forest(agenda, cfg):
     """
-    Turn complete items into a WCFG.
+    Turn complete items into a Forest.
     
-    :param complete_items: complete items (iterable)
-    :returns: a WCFG
+    :param agenda: an Agenda whose complete items are over interned symbols
+    :param cfg: the InternedWCFG the items were derived from
+    :returns: a Forest
     """
-    forest = WCFG()
-    for item in complete_items:
-        lhs = make_symbol(item.lhs, item.start, item.dot)
-        rhs = []
-        for i, sym in enumerate(item.rule.rhs):
-            rhs.append(make_symbol(sym, item.state(i), item.state(i + 1)))
-        forest.add(Rule(lhs, rhs, item.rule.prob))
+    forest = Forest(cfg.vocab)
+    for item in agenda.itercomplete():
+        lhs = forest.make_node(item.lhs, item.start, item.dot)
+        # one edge for each way of splitting the span among the RHS symbols
+        for states in agenda.states(item):
+            rhs = []
+            for i, sym in enumerate(item.rule.rhs):
+                rhs.append(forest.make_node(sym, states[i], states[i + 1]))
+            forest.add(Rule(lhs, rhs, cfg.prob(item.rule)), cfg.rule_id(item.rule))
     return forest
 
-def make_chart(complete_items, n):
-    chart = [[defaultdict(list) for j in range(n)] for i in range(n)] # n by n matrix with edges
-    for item in complete_items:
-        chart[item.start][item.dot][item.lhs].append((item.rule, item.dots_))
+def intern_sentence(cfg, sentence):
+    """map words to terminal ids (unknown words get -1, which no rule can scan)"""
+    return [cfg.vocab.get(word, -1) for word in sentence]
+
+def make_chart(agenda, n):
+    chart = [[defaultdict(list) for j in range(n + 1)] for i in range(n + 1)] # n by n matrix with edges
+    for item in agenda.itercomplete():
+        for states in agenda.states(item):
+            chart[item.start][item.dot][item.lhs].append((item.rule, states))
     return chart
                 
-def cky(cfg, sentence):
-    A = Agenda()
-    for item in cky_axioms(cfg, sentence):
+def cky(cfg, sentence, agenda=None, stats=None, allowed=None):
+    """
+    Parse a sentence with CKY.
+
+    :param cfg: a WCFG
+    :param sentence: the input sentence (as a list or tuple)
+    :param agenda: an empty Agenda to run the program with (by default a new one)
+    :param stats: a dictionary of counters (see cky_axioms)
+    :param allowed: if given, a function (sym_id, start, end) -> bool, complete items
+        for which it is False are discarded (see dense.pruned_cky)
+    :returns: a Forest (use `forest.node(start, 0, len(sentence))` to get the goal node)
+    """
+    icfg = cfg.interned()
+    sentence = intern_sentence(cfg, sentence)
+    A = Agenda() if agenda is None else agenda
+    for item in cky_axioms(icfg, sentence, stats):
         A.push(item)
     while A:
         item = A.pop()
-        if item.is_complete() or is_nonterminal(item.next):
-            for new in complete(item, A):
-                A.push(new)
+        if item.is_complete() or icfg.is_nonterminal(item.next):
+            new_items = complete(item, A)
         else:
             new = scan(item, sentence)
-            if new is not None:
+            new_items = [new] if new is not None else []
+        for new in new_items:
+            if allowed is None or not new.is_complete() or allowed(new.lhs, new.start, new.dot):
                 A.push(new)
         A.make_passive(item)
-    return make_forest(A.itercomplete())
+    return make_forest(A, icfg)
     
     
     
\ No newline at end of file
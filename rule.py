@@ -2,6 +2,12 @@ from collections import defaultdict
 
 class Rule(object):
 
+    # rules are created once per grammar (and once per edge of a forest), and hashed every time
+    # an item is pushed, so we do not give them a __dict__ and we compute their hash only once
+    # a rule is identified by its LHS and RHS only: its probability is just the weight it was
+    # created with, a WCFG keeps the current probability of each rule in a vector (see WCFG.probs)
+    __slots__ = ('lhs_', 'rhs_', 'prob_', 'hash_')
+
     def __init__(self, lhs, rhs, prob):
         """
         Constructs a Rule.
@@ -13,15 +19,24 @@ class Rule(object):
         self.lhs_ = lhs
         self.rhs_ = tuple(rhs)
         self.prob_ = prob
+        self.hash_ = hash((self.lhs_, self.rhs_))
 
     def __eq__(self, other):
-        return self.lhs_ == other.lhs_ and self.rhs_ == other.rhs_ and self.prob_ == other.prob_
+        if self is other:
+            return True
+        return self.hash_ == other.hash_ and self.lhs_ == other.lhs_ and self.rhs_ == other.rhs_
 
     def __ne__(self, other):
         return not (self == other)
 
     def __hash__(self):
-        return hash((self.lhs_, self.rhs_, self.prob_))
+        return self.hash_
+
+    def __getstate__(self):
+        return (self.lhs_, self.rhs_, self.prob_)
+
+    def __setstate__(self, state):
+        self.__init__(*state)
 
     def __repr__(self):
         return '%s -> %s (%s)' % (self.lhs_,
@@ -5,8 +5,13 @@ The conditional independence assumption central to PCFGs make them convenient fo
 The code below is very similar to the Viterbi code above, however, instead of maximising at each step, 
 we draw a random edge from the distribution defined by their inside weights. 
 """
-from collections import deque
+from collections import deque, defaultdict
+from math import exp, lgamma
+import multiprocessing
 import random
+import numpy as np
+from cache import ForestCache
+from semiring import Probability, inside_values
 
 def ancestral_sample(forest, I, start):
     """
@@ -30,7 +35,7 @@ def ancestral_sample(forest, I, start):
         # here we compute the distribution over edges
         weights = [0.0] * len(incoming)
         for i, rule in enumerate(incoming):
-            weights[i] = rule.prob
+            weights[i] = forest.prob(rule)
             for child in rule.rhs:
                 weights[i] *= I[child]
         # here we draw a random threshold (think of it as sampling from the inverted CDF)
@@ -51,106 +56,389 @@ def ancestral_sample(forest, I, start):
             selected = back
         # every nonterminal child of the selected edge must be added to the queue
         for sym in selected.rhs:
-            if is_nonterminal(sym):
+            if forest.is_nonterminal(sym):
                 Q.append(sym)
         d.append(selected)
     return d
 
+
+def edge_distribution(forest, I, node):
+    """
+    The distribution over the incoming edges of a node, as a cumulative array.
+
+    :returns: (edges, cdf) where edges is a list of rules and cdf[i] is the
+        probability of choosing one of edges[0..i] (thus cdf[-1] is 1)
+    """
+    edges = list(forest.get(node))
+    weights = np.array([forest.prob(rule) for rule in edges])
+    for i, rule in enumerate(edges):
+        for child in rule.rhs:
+            weights[i] *= I[child]
+    cdf = np.cumsum(weights)
+    return edges, cdf / cdf[-1]
+
+
+def sample_many(forest, I, start, k, rng=None):
+    """
+    Draw k derivations by ancestral sampling, all at once.
+
+    The distribution over the incoming edges of a node is the same for every sample,
+    thus we compute it once (see `edge_distribution`), the first time some sample visits
+    the node. We then expand the k derivations top-down together: at each level, all
+    samples that need a node draw their edges with one vector of random numbers and
+    a binary search in the cumulative array of the node.
+
+    :param forest: a derrivation forest in WCFG form
+    :param I: an inside dictionary
+    :param start: the starting symbol
+    :param k: number of samples
+    :param rng: a numpy RandomState (by default numpy's global one)
+    :returns: a list of k derivations, each a list of rules
+    """
+    if rng is None:
+        rng = np.random
+    distributions = dict()  # node -> (edges, cdf)
+    derivations = [[] for _ in range(k)]
+    frontier = {start: list(range(k))}  # node -> samples that must expand it
+    while frontier:
+        below = defaultdict(list)
+        for node, samples in frontier.items():
+            dist = distributions.get(node, None)
+            if dist is None:
+                dist = edge_distribution(forest, I, node)
+                distributions[node] = dist
+            edges, cdf = dist
+            # the first edge whose cdf exceeds the threshold (clipped for rounding problems)
+            choices = np.searchsorted(cdf, rng.random_sample(len(samples)), side='right')
+            np.minimum(choices, len(edges) - 1, out=choices)
+            for sample, choice in zip(samples, choices.tolist()):
+                selected = edges[choice]
+                derivations[sample].append(selected)
+                for sym in selected.rhs:
+                    if forest.is_nonterminal(sym):
+                        below[sym].append(sample)
+        frontier = below
+    return derivations
+
 """
-Helper functions for gibs_sample.
+Gibbs sampling of the rule probabilities and the trees of a corpus (Johnson et al., 2007).
+
+The state of the sampler is a vector of rule counts (indexed by rule id) summed over the
+current tree of every sentence. A sweep alternates:
+    theta ~ Dirichlet(alpha + counts), one Dirichlet per LHS, drawn at once (see sample_thetas)
+    t_i ~ p(t | w_i, theta) for every sentence, by ancestral sampling in its (cached) forest
+and replaces the counts of the old trees of each sentence by those of its new trees.
 """
 
-def sample_thetas(alphas):
-    """
-    :param alphas: a dictionary with dictionaries. Nonterminal A as key. As values 
-    a dictionary with rules R that start with nonerminal A as keys and the alpha_R 
-    Dirichlet pseudocounts as value:
-    
-    alphas = {A: {A -> B C: alpha_{A -> B C}, A -> a: alpha_{A -> a}}, 
-              B: {B -> b: alpha_{A -> B C},...},
-              ...}
-    
-    :returns: thetas drawn from a Dirichlet(alpha_A) for each nonerminal A in the same format as alphas.
-    """
-    thetas = {}
-    # for each A we sample theta_A independently
-    for A in G.nonterminals: 
-        alpha_A = [alphas[A][R] for R in G.get(A)]
-        theta_A = np.random.dirichlet(alpha_A)
-        thetas[A] = {R: theta_A[i] for i, R in enumerate(G.get(A))}
-    return thetas
+def sample_thetas(grammar, alphas, rng=None):
+    """
+    Draw the probabilities of all rules from a Dirichlet per LHS.
+
+    A Dirichlet(alpha_A) draw is a vector of independent Gamma(alpha_R, 1) draws
+    normalised to sum to one, thus we draw one gamma per rule and normalise by LHS.
+
+    :param grammar: a WCFG
+    :param alphas: Dirichlet pseudocounts indexed by rule id
+    :param rng: a numpy RandomState (by default numpy's global one)
+    :returns: a probability vector indexed by rule id
+    """
+    if rng is None:
+        rng = np.random
+    _, index = grammar.lhs_index()
+    draws = rng.gamma(np.asarray(alphas, dtype=float))
+    return draws / np.bincount(index, weights=draws)[index]
 
 def update_grammar(G, thetas):
     """
     :param G: a WCFG grammar
-    :param thetas: thetas_A for all nonterminals A in G in the (peculiar) format 
-    as returned by sample_thetas
+    :param thetas: a probability vector indexed by rule id (as returned by sample_thetas)
     :returns: a WCFG new_G with the old thetas replaced by the new thetas
+        (new_G shares the rules of G, only the probability vector is new)
     """
-    new_G = WCFG()
-    for A in G.nonterminals:
-        for rule, new_theta in thetas[A].iteritems():
-            new_G.add(Rule(rule.lhs, rule.rhs, new_theta))
-    return new_G
+    return G.reweight(thetas)
 
-def update_alphas(alphas, grammar, tree):
-    for A in grammar.nonterminals:
-        for rule in alphas[A]:
-            alphas[A][rule] += len(get_instances(rule, tree))
-    return alphas
+def tree_rule_ids(forest, trees):
+    """the ids of the grammar rules used by some trees (a vector, with repetitions)"""
+    return np.array([forest.grammar_rule_id(forest.rule_id(rule)) for tree in trees for rule in tree], dtype=int)
 
-def make_samples(G):
+def make_samples(G, cache, rng=None):
+    """
+    :param G: a WCFG
+    :param cache: a ForestCache of the corpus (parsed with the rules of G),
+        its forests are reweighted with G instead of parsing again
+    :param rng: a numpy RandomState (by default numpy's global one)
+    :returns: one tree per sentence (repeated sentences come together, in the order of
+        their first occurrence)
+    """
     samples = []
-    for sentence in small_corpus:
-        goal = make_symbol('[E]', 0, len(sentence))
-        forest = cky(G, sentence)
-#         forest = earley(G, sentence, '[E]')
-        I = inside(forest, goal)
-        samples.append(sample(forest, I, goal))
+    for i, (forest, goal) in enumerate(cache.forests(G)):
+        # a repeated sentence is parsed and scored once, but each occurrence gets its own tree
+        I, _ = inside_values(forest, Probability, goal)
+        samples.extend(sample_many(forest, I, goal, cache.count(i), rng))
     return samples
 
-def gibs_sample(n, G, alphas):
-    # for plotting
-    d = defaultdict(list)
-    # saving the correct probs of the grammar
-    for rule in G:
-            ruled = Rule(rule.lhs, rule.rhs, None) # prob=None so we can find the rules 
-            d[ruled].append(rule.prob)            # in the dict even as probs change
-    
-    for i in range(n):
-        # sample p(theta|t,w,alpha)
-        thetas = sample_thetas(alphas)
-        # update G with these thetas
-        new_G = update_grammar(G, thetas) 
-
-        # sample p(t|theta,w,alpha)
-        samples = make_samples(new_G) # for each w_i in the corpus sample one t_i based on new_G
-        
-        # saving thetas per rule for plotting 
-        for rule in new_G:
-            ruled = Rule(rule.lhs, rule.rhs, None)
-            d[ruled].append(rule.prob)
-            
-        # update alpha with rule counts
-        for tree in samples:
-            new_alphas = update_alphas(alphas, G, tree) # need not use new_G here: probs play no roles
-                                                        # grammar only needed to get rules by nonerminals
-        G = new_G
-        alphas = new_alphas
-    
-    # for plotting 
+# the state of a worker process (see _init_gibbs_worker)
+_gibbs_grammar = None
+_gibbs_cache = None
+
+def _init_gibbs_worker(grammar, cache):
+    """each worker receives the grammar and the forests once, when the pool starts"""
+    global _gibbs_grammar, _gibbs_cache
+    _gibbs_grammar = grammar
+    _gibbs_cache = cache
+
+def _gibbs_shard(task):
+    """new trees (as vectors of rule ids) for a shard of distinct sentences"""
+    indices, thetas, seed = task
+    grammar = _gibbs_grammar.reweight(thetas)
+    rng = np.random.RandomState(seed)
+    trees = []
+    for i in indices:
+        forest, goal = _gibbs_cache.forest(i, grammar), _gibbs_cache.goal(i)
+        I, _ = inside_values(forest, Probability, goal)
+        trees.append(tree_rule_ids(forest, sample_many(forest, I, goal, _gibbs_cache.count(i), rng)))
+    return trees
+
+
+class GibbsSampler(object):
+
+    def __init__(self, grammar, sentences, alpha=1.0, start='[E]', shard_size=16, seed=None, cache=None):
+        """
+        :param grammar: a WCFG (its probabilities are only used if we start from trees, see `sweep`)
+        :param sentences: a list of sentences or a WeightedCorpus
+        :param alpha: the Dirichlet pseudocounts, a number or a vector indexed by rule id
+        :param start: the start symbol
+        :param shard_size: number of distinct sentences per task of a worker
+        :param seed: seeds the sampler, the samples then do not depend on the number of workers
+        :param cache: a ForestCache of the sentences parsed with the rules of grammar
+        """
+        self._cache = ForestCache(grammar, sentences, start) if cache is None else cache
+        self._base = grammar
+        self._alphas = np.zeros(len(grammar)) + alpha
+        self._rng = np.random.RandomState(seed)
+        n = len(self._cache)
+        self._shards = [range(i, min(i + shard_size, n)) for i in range(0, n, shard_size)]
+        self._counts = np.zeros(len(grammar))
+        self._trees = [None] * n  # distinct sentence -> rule ids of its current trees
+        self._grammar = grammar
+        self._sweeps = 0
+
+    @property
+    def grammar(self):
+        """the grammar with the last probabilities we drew"""
+        return self._grammar
+
+    @property
+    def counts(self):
+        """the rule counts (indexed by rule id) of the current trees"""
+        return self._counts
+
+    @property
+    def sweeps(self):
+        return self._sweeps
+
+    def _sample_trees(self, thetas, pool=None):
+        tasks = [(shard, thetas, seed) for shard, seed in
+                 zip(self._shards, self._rng.randint(2 ** 31 - 1, size=len(self._shards)))]
+        if pool is not None:
+            results = pool.map(_gibbs_shard, tasks)
+        else:
+            _init_gibbs_worker(self._base, self._cache)
+            results = [_gibbs_shard(task) for task in tasks]
+        m = len(self._counts)
+        for shard, trees in zip(self._shards, results):
+            for i, rule_ids in zip(shard, trees):
+                # we replace the counts of the old trees of the sentence by those of the new ones
+                if self._trees[i] is not None:
+                    self._counts -= np.bincount(self._trees[i], minlength=m)
+                self._counts += np.bincount(rule_ids, minlength=m)
+                self._trees[i] = rule_ids
+
+    def sweep(self, pool=None):
+        """
+        One Gibbs sweep: new probabilities given the trees, then new trees given the probabilities.
+
+        The first sweep has no trees yet, thus it samples them from the initial grammar.
+
+        :param pool: a multiprocessing.Pool initialised with _init_gibbs_worker (see `run`)
+        :returns: the new grammar
+        """
+        if self._sweeps > 0:
+            self._grammar = update_grammar(self._base, sample_thetas(self._base, self._alphas + self._counts, self._rng))
+        self._sample_trees(self._grammar.probs, pool)
+        self._sweeps += 1
+        return self._grammar
+
+    def run(self, n, workers=1, callback=None):
+        """
+        Run n sweeps.
+
+        :param workers: number of worker processes sampling trees (the pool lives for all sweeps)
+        :param callback: if given, called with the sampler after each sweep (e.g. to record a path)
+        :returns: the last grammar
+        """
+        pool = None
+        if workers > 1 and len(self._shards) > 1:
+            pool = multiprocessing.Pool(workers, _init_gibbs_worker, (self._base, self._cache))
+        try:
+            for _ in range(n):
+                self.sweep(pool)
+                if callback is not None:
+                    callback(self)
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+        return self._grammar
+
+
+class CollapsedSampler(object):
+    """
+    A collapsed Metropolis-Hastings sampler of the trees of a corpus (Johnson, Griffiths & Goldwater, 2007).
+
+    The rule probabilities are integrated out, thus the state is the trees alone (and their
+    rule counts). A step visits one sentence: we remove the counts of its tree t, and propose
+    a tree t' from the proposal grammar whose probabilities are the posterior means given the
+    other trees, theta'_R = (c_R + alpha_R) / (c_A + alpha_A). The exact conditional of t is
+    P(t | other trees), a ratio of Dirichlet normalisers, thus we accept t' with probability
+
+        min{1, P(t' | other trees) theta'(t) / (P(t | other trees) theta'(t'))}
+
+    and add the counts of the tree we keep. The proposal only needs theta' for the rules of the
+    forest of the sentence, which we compute from the counts (and the counts per LHS, kept up to
+    date along with them), thus a step costs the size of a forest, never that of the grammar.
+    """
+
+    def __init__(self, grammar, sentences, alpha=1.0, start='[E]', seed=None, cache=None):
+        """
+        :param grammar: a WCFG (only its rules matter)
+        :param sentences: a list of sentences or a WeightedCorpus
+        :param alpha: the Dirichlet pseudocounts, a number or a vector indexed by rule id
+        :param start: the start symbol
+        :param seed: seeds the sampler
+        :param cache: a ForestCache of the sentences parsed with the rules of grammar
+        """
+        self._cache = ForestCache(grammar, sentences, start) if cache is None else cache
+        self._grammar = grammar
+        self._alphas = np.zeros(len(grammar)) + alpha
+        lhs, self._lhs = grammar.lhs_index()
+        self._lhs_alphas = np.bincount(self._lhs, weights=self._alphas, minlength=len(lhs))
+        self._counts = np.zeros(len(grammar))
+        self._lhs_counts = np.zeros(len(lhs))
+        self._rng = np.random.RandomState(seed)
+        self._edge_rule_ids = [self._cache.forest(i).grammar_rule_ids() for i in range(len(self._cache))]
+        # every occurrence of a sentence has its own tree: an item is a pair (distinct sentence, occurrence)
+        self._items = [(i, j) for i in range(len(self._cache)) for j in range(self._cache.count(i))]
+        self._trees = dict()  # item -> rule ids of its tree
+        self._proposed = 0
+        self._accepted = 0
+
+    @property
+    def counts(self):
+        """the rule counts (indexed by rule id) of the current trees"""
+        return self._counts
+
+    def acceptance_rate(self):
+        """the fraction of the proposed trees that we accepted"""
+        return self._accepted / float(self._proposed) if self._proposed else 0.0
+
+    @property
+    def grammar(self):
+        """the grammar with the posterior mean of the probabilities given the current trees"""
+        return self._grammar.reweight(self._grammar.normalize(self._counts + self._alphas))
+
+    def _update(self, rule_ids, sign):
+        np.add.at(self._counts, rule_ids, sign)
+        np.add.at(self._lhs_counts, self._lhs[rule_ids], sign)
+
+    def _posterior_means(self, rule_ids):
+        """theta'_R = (c_R + alpha_R) / (c_A + alpha_A) for some rule ids"""
+        lhs = self._lhs[rule_ids]
+        return (self._counts[rule_ids] + self._alphas[rule_ids]) / (self._lhs_counts[lhs] + self._lhs_alphas[lhs])
+
+    def _log_predictive(self, rule_ids):
+        """log P(t | the trees in the counts) for a tree t given by its rule ids"""
+        ids, n = np.unique(rule_ids, return_counts=True)
+        a = (self._counts[ids] + self._alphas[ids]).tolist()
+        lhs, m = np.unique(self._lhs[rule_ids], return_counts=True)
+        b = (self._lhs_counts[lhs] + self._lhs_alphas[lhs]).tolist()
+        return (sum(lgamma(x + k) - lgamma(x) for x, k in zip(a, n.tolist())) -
+                sum(lgamma(x + k) - lgamma(x) for x, k in zip(b, m.tolist())))
+
+    def step(self, item):
+        """
+        Resample the tree of an item (see `items`).
+
+        :returns: whether we accepted the proposed tree
+        """
+        i = item[0]
+        old = self._trees.get(item, None)
+        if old is not None:
+            self._update(old, -1)
+        # the proposal: each edge of the forest takes the posterior mean of its rule
+        forest = self._cache.forest(i).reweight(self._posterior_means(self._edge_rule_ids[i]))
+        goal = self._cache.goal(i)
+        I, _ = inside_values(forest, Probability, goal)
+        new = tree_rule_ids(forest, sample_many(forest, I, goal, 1, self._rng))
+        accept = True
+        if old is not None:
+            log_ratio = ((self._log_predictive(new) - np.log(self._posterior_means(new)).sum()) -
+                         (self._log_predictive(old) - np.log(self._posterior_means(old)).sum()))
+            accept = log_ratio >= 0.0 or self._rng.random_sample() < exp(log_ratio)
+            self._proposed += 1
+            self._accepted += accept
+        self._update(new if accept else old, 1)
+        self._trees[item] = new if accept else old
+        return accept
+
+    def items(self):
+        """the items (pairs of a distinct sentence and an occurrence of it)"""
+        return self._items
+
+    def sweep(self):
+        """resample the tree of every item, in a random order"""
+        for k in self._rng.permutation(len(self._items)):
+            self.step(self._items[k])
+
+    def run(self, n, callback=None):
+        """
+        Run n sweeps.
+
+        :param callback: if given, called with the sampler after each sweep
+        :returns: the posterior mean grammar
+        """
+        for _ in range(n):
+            self.sweep()
+            if callback is not None:
+                callback(self)
+        return self.grammar
+
+
+def gibs_sample(n, G, corpus, alpha=1.0, workers=1, seed=None):
+    """
+    Run a GibbsSampler and record the probability of every rule after each sweep.
+
+    :returns: (new_G, path) where path is a list of probability vectors (indexed by
+        rule id), starting with the probabilities of G
+    """
+    path = [G.probs.copy()]
+    sampler = GibbsSampler(G, corpus, alpha, seed=seed)
+    new_G = sampler.run(n, workers, lambda s: path.append(s.grammar.probs.copy()))
+    return new_G, path
+
+def plot_gibs_sample(G, path):
+    """plot the sample path of each rule (solid) against its probability in G (dashed)"""
+    import matplotlib.pyplot as plt
     colors = ['tab:blue', 'tab:orange', 'tab:green', 'tab:red', 'tab:purple', 
               'tab:brown', 'tab:pink', 'tab:gray', 'tab:olive', 'tab:cyan']
-    i = 0
-    for rule, prob in d.iteritems():
+    path = np.array(path)
+    n = len(path) - 1
+    for rule in G:
+        r = G.rule_id(rule)
+        color = colors[r % len(colors)]
         # plot correct values with ---
-        plt.plot(range(n+1), [prob[0]]*(n+1), '--', color=colors[i], )
+        plt.plot(range(n+1), [G.prob(rule)]*(n+1), '--', color=color)
         # plot gibs sample-path with solid line
-        plt.plot(range(n+1), prob, color=colors[i])
-        i += 1
-    
+        plt.plot(range(n+1), path[:, r], color=color)
     plt.show()
     plt.clf()
-    
-    return new_G, alphas
-
@@ -0,0 +1,300 @@
+"""
+Semirings and a generic evaluator of forests.
+
+The inside recursion, counting derivations and finding the best derivation are the
+same computation over a forest, each in a different semiring. The evaluator visits
+the nodes of a Forest once, bottom-up in its (cached) topological order, and the
+semiring says how to combine edges (plus) and children (times).
+
+A semiring here is a class with:
+    zero, one: the identities of plus and times
+    plus(a, b), times(a, b)
+    sum(values), product(values): the same over a list (which we call once per node/edge)
+    from_prob(p): the value of an edge whose rule has probability p
+    idempotent: whether plus(a, b) is always a or b, in which case the evaluator also keeps back-pointers
+"""
+import math
+
+NEG_INF = float('-inf')
+
+
+class Semiring(object):
+
+    zero = None
+    one = None
+    idempotent = False
+
+    @classmethod
+    def sum(cls, values):
+        total = cls.zero
+        for value in values:
+            total = cls.plus(total, value)
+        return total
+
+    @classmethod
+    def product(cls, values):
+        total = cls.one
+        for value in values:
+            total = cls.times(total, value)
+        return total
+
+
+class Probability(Semiring):
+    """sum-product over probabilities (the inside recursion)"""
+
+    zero = 0.0
+    one = 1.0
+
+    @staticmethod
+    def plus(a, b):
+        return a + b
+
+    @staticmethod
+    def times(a, b):
+        return a * b
+
+    @staticmethod
+    def sum(values):
+        return math.fsum(values)
+
+    @staticmethod
+    def product(values):
+        total = 1.0
+        for value in values:
+            total *= value
+        return total
+
+    @staticmethod
+    def from_prob(p):
+        return p
+
+
+class LogProbability(Semiring):
+    """sum-product over log-probabilities, which does not underflow on long sentences"""
+
+    zero = NEG_INF
+    one = 0.0
+
+    @staticmethod
+    def plus(a, b):
+        return logsumexp([a, b])
+
+    @staticmethod
+    def times(a, b):
+        return a + b
+
+    @staticmethod
+    def sum(values):
+        return logsumexp(values)
+
+    @staticmethod
+    def product(values):
+        return sum(values)
+
+    @staticmethod
+    def from_prob(p):
+        return math.log(p) if p > 0.0 else NEG_INF
+
+
+class Viterbi(Semiring):
+    """max-times over probabilities (the best derivation)"""
+
+    zero = 0.0
+    one = 1.0
+    idempotent = True
+
+    @staticmethod
+    def plus(a, b):
+        return max(a, b)
+
+    @staticmethod
+    def times(a, b):
+        return a * b
+
+    @staticmethod
+    def sum(values):
+        return max(values) if values else 0.0
+
+    @staticmethod
+    def product(values):
+        total = 1.0
+        for value in values:
+            total *= value
+        return total
+
+    @staticmethod
+    def from_prob(p):
+        return p
+
+
+class LogViterbi(Semiring):
+    """max-plus over log-probabilities (the best derivation, without underflow)"""
+
+    zero = NEG_INF
+    one = 0.0
+    idempotent = True
+
+    @staticmethod
+    def plus(a, b):
+        return max(a, b)
+
+    @staticmethod
+    def times(a, b):
+        return a + b
+
+    @staticmethod
+    def sum(values):
+        return max(values) if values else NEG_INF
+
+    @staticmethod
+    def product(values):
+        return sum(values)
+
+    @staticmethod
+    def from_prob(p):
+        return math.log(p) if p > 0.0 else NEG_INF
+
+
+class Counting(Semiring):
+    """sum-product over integers where every edge weighs 1 (the number of derivations)"""
+
+    zero = 0
+    one = 1
+
+    @staticmethod
+    def plus(a, b):
+        return a + b
+
+    @staticmethod
+    def times(a, b):
+        return a * b
+
+    @staticmethod
+    def sum(values):
+        return sum(values)
+
+    @staticmethod
+    def from_prob(p):
+        return 1
+
+
+class Expectation(Semiring):
+    """
+    The first-order expectation semiring (Eisner, 2002) over pairs (p, r).
+
+    If an edge with probability p carries a value f, it weighs (p, p * f). The inside value
+    of a node is then (Z, sum_d p(d) f(d)), where f(d) is the sum of f over the edges of d.
+    """
+
+    zero = (0.0, 0.0)
+    one = (1.0, 0.0)
+
+    @staticmethod
+    def plus(a, b):
+        return (a[0] + b[0], a[1] + b[1])
+
+    @staticmethod
+    def times(a, b):
+        return (a[0] * b[0], a[0] * b[1] + a[1] * b[0])
+
+    @staticmethod
+    def from_prob(p):
+        return (p, 0.0)
+
+
+def logsumexp(values):
+    """log(sum(exp(values))) computed without underflow"""
+    m = max(values) if values else NEG_INF
+    if m == NEG_INF:
+        return NEG_INF
+    return m + math.log(math.fsum(math.exp(v - m) for v in values))
+
+
+def edge_weights(forest, semiring):
+    """the value of each edge of the forest (indexed by edge id) in a semiring"""
+    return [semiring.from_prob(p) for p in forest.probs.tolist()]
+
+
+def inside_values(forest, semiring, start=None, weights=None):
+    """
+    Evaluate a forest bottom-up in a semiring.
+
+    :param forest: a Forest
+    :param semiring: a Semiring (class)
+    :param start: if given, only nodes under it are evaluated (others keep semiring.zero)
+    :param weights: the value of each edge (indexed by edge id), by default from the edge probabilities
+    :returns: (values, back) where values is a list indexed by node and, for idempotent
+        semirings, back is a list with the id of the selected incoming edge of each node
+        (or None), otherwise back is None
+    """
+    if weights is None:
+        weights = edge_weights(forest, semiring)
+    n = forest.num_nodes()
+    values = [semiring.zero] * n
+    back = [None] * n if semiring.idempotent else None
+    for node in forest.topological_order(start):
+        edges = forest.incoming_edges(node)
+        if not edges:  # terminals weigh one, a nonterminal without edges is a dead end
+            values[node] = semiring.one if forest.is_terminal(node) else semiring.zero
+            continue
+        scores = [semiring.product([weights[edge]] + [values[child] for child in forest.rule(edge).rhs])
+                  for edge in edges]
+        total = semiring.sum(scores)
+        values[node] = total
+        if back is not None:
+            # the first edge whose score was selected by plus
+            back[node] = edges[scores.index(total)]
+    return values, back
+
+
+def outside_values(forest, semiring, inside, start, weights=None, edge_totals=None):
+    """
+    Evaluate a forest top-down in a semiring.
+
+    :param forest: a Forest
+    :param semiring: a Semiring (class)
+    :param inside: inside values indexed by node (as returned by inside_values)
+    :param start: the root, whose outside value is semiring.one
+    :param weights: the value of each edge (indexed by edge id), by default from the edge probabilities
+    :param edge_totals: if given, a list indexed by edge id (initialised to semiring.zero) where we
+        store, for each edge, the outside value of its head times its weight times the inside
+        values of its children (in the Probability semiring, the total probability of the
+        derivations that use the edge)
+    :returns: a list of outside values indexed by node
+    """
+    if weights is None:
+        weights = edge_weights(forest, semiring)
+    n = forest.num_nodes()
+    zero = semiring.zero
+    outside = [zero] * n
+    for node in reversed(forest.topological_order()):
+        if node == start:
+            outside[node] = semiring.one
+        beta = outside[node]
+        if beta == zero:
+            continue
+        for edge in forest.incoming_edges(node):
+            rhs = forest.rule(edge).rhs
+            k = semiring.times(weights[edge], beta)
+            for position, child in enumerate(rhs):
+                # the outside of a child is the outside of the head times the inside of its siblings
+                siblings = [inside[sibling] for i, sibling in enumerate(rhs) if i != position]
+                outside[child] = semiring.plus(outside[child], semiring.product([k] + siblings))
+            if edge_totals is not None:
+                edge_totals[edge] = semiring.product([k] + [inside[child] for child in rhs])
+    return outside
+
+
+def expectation(forest, start, feature):
+    """
+    The expected value of an additive function of derivations.
+
+    :param forest: a Forest
+    :param start: the start symbol (a node of the forest)
+    :param feature: a function from edge id to a number, f(d) is its sum over the edges of d
+    :returns: sum_d p(d|x) f(d)
+    """
+    weights = [(p, p * feature(edge)) for edge, p in enumerate(forest.probs.tolist())]
+    values, _ = inside_values(forest, Expectation, start, weights)
+    Z, r = values[start]
+    return r / Z
@@ -0,0 +1,199 @@
+"""
+An incremental probabilistic Earley parser (Stolcke, 1995).
+
+Tokens are fed one at a time and the chart is kept between tokens, thus the cost of a
+token is the work of its own column, not a reparse of the prefix. Each state carries a
+forward probability (alpha), the total probability of the derivations of the prefix that
+use it, and an inner probability (gamma), that of the part of the input it spans.
+After each token we know the prefix probability P(S =>* x_1 ... x_j ...) and the terminals
+that may come next.
+
+Left recursion and chains of unit rules are summed up in closed form:
+    R_L = (I - P_L)^-1 where P_L[X, Y] is the total probability of the rules X -> Y ...
+    R_U = (I - P_U)^-1 where P_U[X, Y] is the probability of the rule X -> Y
+thus prediction and completion never loop. Rules with an empty RHS are not supported.
+"""
+import numpy as np
+
+
+class IncrementalEarley(object):
+
+    def __init__(self, cfg, start):
+        """
+        :param cfg: a WCFG (whose probabilities we use as they are now)
+        :param start: the start symbol (str)
+        """
+        self._cfg = cfg.interned()
+        self._vocab = cfg.vocab
+        if any(len(rule.rhs) == 0 for rule in self._cfg):
+            raise ValueError('I do not support rules with an empty RHS')
+        self._start = self._vocab[start]
+        self._probs = self._cfg.probs.copy()
+        self._closures()
+        # a column j is a dictionary (rule id, pos, start) -> [rule, pos, start, alpha, gamma]
+        # together with an index of its incomplete states by the symbol they wait for
+        self._columns = [dict()]
+        self._waiting = [dict()]
+        self._prefix_probs = [1.0]
+
+    def _closures(self):
+        """compute R_L and R_U (over nonterminals) as sparse lists"""
+        cfg = self._cfg
+        nonterminals = sorted(cfg.nonterminals)
+        index = dict((X, k) for k, X in enumerate(nonterminals))
+        n = len(nonterminals)
+        P_L = np.zeros((n, n))
+        P_U = np.zeros((n, n))
+        for rule_id, rule in enumerate(cfg):
+            first = rule.rhs[0]
+            if cfg.is_nonterminal(first):
+                P_L[index[rule.lhs], index[first]] += self._probs[rule_id]
+                if len(rule.rhs) == 1:
+                    P_U[index[rule.lhs], index[first]] += self._probs[rule_id]
+        try:
+            R_L = np.linalg.inv(np.eye(n) - P_L)
+            R_U = np.linalg.inv(np.eye(n) - P_U)
+        except np.linalg.LinAlgError:
+            R_L = R_U = None
+        if R_L is None or (R_L < 0).any() or (R_U < 0).any():  # the geometric series diverges
+            raise ValueError('I need a proper PCFG: the left-corner relation has no closure')
+        # we only keep the entries of the closures that are reachable (the rest is numerical noise)
+        self._left = dict()  # X -> [(Z, R_L[X, Z])] for Z in the left-corner closure of X
+        for X in nonterminals:
+            self._left[X] = [(Z, R_L[index[X], index[Z]]) for Z in cfg.left_corners(X)]
+        # Z =>* Y through unit rules: we walk the unit rules backwards from Y
+        parents = dict()
+        for rule in cfg:
+            if self._is_unit(rule):
+                parents.setdefault(rule.rhs[0], set()).add(rule.lhs)
+        self._unit = dict()  # Y -> [(Z, R_U[Z, Y])] for Z =>* Y through unit rules only
+        for Y in nonterminals:
+            closure = [Y]
+            seen = set(closure)
+            for Z in closure:
+                for X in parents.get(Z, ()):
+                    if X not in seen:
+                        seen.add(X)
+                        closure.append(X)
+            self._unit[Y] = [(Z, R_U[index[Z], index[Y]]) for Z in closure]
+
+    def __len__(self):
+        """number of tokens fed so far"""
+        return len(self._columns) - 1
+
+    def prefix_prob(self):
+        """the probability that a sentence starts with the tokens fed so far"""
+        return self._prefix_probs[-1]
+
+    def sentence_prob(self):
+        """the probability of the tokens fed so far as a complete sentence"""
+        total = 0.0
+        for state in self._columns[len(self)].values():
+            rule, pos, start, _, gamma = state
+            if pos == len(rule.rhs) and start == 0 and not self._is_unit(rule):
+                for Z, r in self._unit[rule.lhs]:
+                    if Z == self._start:
+                        total += r * gamma
+        return total
+
+    def viable(self):
+        """the terminals (str) that can come next with nonzero probability"""
+        terminals = set()
+        j = len(self)
+        waiting = self._waiting[j]
+        symbols = [self._start] if j == 0 else [sym for sym, states in waiting.items() if states]
+        for sym in symbols:
+            terminals.update(self._cfg.first_terminals(sym))
+        return set(self._vocab.symbol(t) for t in terminals)
+
+    def feed(self, token):
+        """
+        Parse one more token.
+
+        :param token: a terminal (str)
+        :returns: the new prefix probability
+        """
+        j = len(self)
+        word = self._vocab.get(token, -1)
+        if word != -1 and self._vocab.is_nonterminal(word):
+            word = -1
+        self._predict(j, word)
+        self._columns.append(dict())
+        self._waiting.append(dict())
+        prefix = 0.0
+        for state in self._waiting[j].get(word, ()):
+            rule, pos, start, alpha, gamma = state
+            self._add(j + 1, rule, pos + 1, start, alpha, gamma)
+            prefix += alpha
+        self._complete(j + 1)
+        self._prefix_probs.append(prefix)
+        return prefix
+
+    def _add(self, j, rule, pos, start, alpha, gamma):
+        """add probability mass to a state of column j (creating it if necessary)"""
+        key = (self._cfg.rule_id(rule), pos, start)
+        state = self._columns[j].get(key, None)
+        if state is None:
+            state = [rule, pos, start, 0.0, 0.0]
+            self._columns[j][key] = state
+            if pos < len(rule.rhs):
+                self._waiting[j].setdefault(rule.rhs[pos], []).append(state)
+        state[3] += alpha
+        state[4] += gamma
+        return state
+
+    def _predict(self, j, word):
+        """
+        Predict, in column j, the rules that can start with `word`.
+
+        The forward probability of [Z -> * nu, j] is sum_Y alpha(Y) R_L[Y, Z] p(Z -> nu), where
+        alpha(Y) is the total forward probability of the states of column j waiting for Y.
+        """
+        if j == 0:
+            awaited = {self._start: 1.0}
+        else:
+            awaited = dict()
+            for sym, states in self._waiting[j].items():
+                if self._vocab.is_nonterminal(sym):
+                    awaited[sym] = sum(state[3] for state in states)
+        weights = dict()
+        for Y, alpha in awaited.items():
+            for Z, r in self._left.get(Y, ()):
+                weights[Z] = weights.get(Z, 0.0) + alpha * r
+        for rule in self._cfg.starting_with(word):
+            w = weights.get(rule.lhs, 0.0)
+            if w > 0.0:
+                p = self._probs[self._cfg.rule_id(rule)]
+                self._add(j, rule, 0, j, w * p, p)
+
+    def _is_unit(self, rule):
+        return len(rule.rhs) == 1 and self._cfg.is_nonterminal(rule.rhs[0])
+
+    def _complete(self, j):
+        """
+        Complete the states of column j.
+
+        A complete state [Y -> nu *, k] (not a unit rule) advances each state [X -> lambda * Z mu, i]
+        of column k such that Z =>* Y through unit rules:
+            alpha += alpha(X) R_U[Z, Y] gamma(Y)
+            gamma += gamma(X) R_U[Z, Y] gamma(Y)
+        Completed states start before their completor, thus we process them from the
+        rightmost start to the leftmost, each once all its mass has arrived.
+        """
+        by_start = dict()
+        for state in self._columns[j].values():
+            if state[1] == len(state[0].rhs):
+                by_start.setdefault(state[2], []).append(state)
+        for k in range(j - 1, -1, -1):
+            for completor in by_start.get(k, ()):
+                rule, _, _, _, gamma = completor
+                if self._is_unit(rule):  # already accounted for by R_U
+                    continue
+                for Z, r in self._unit.get(rule.lhs, ()):
+                    for waiting in self._waiting[k].get(Z, ()):
+                        new_rule, pos, i = waiting[0], waiting[1] + 1, waiting[2]
+                        key = (self._cfg.rule_id(new_rule), pos, i)
+                        is_new = key not in self._columns[j]
+                        state = self._add(j, new_rule, pos, i, waiting[3] * r * gamma, waiting[4] * r * gamma)
+                        if is_new and pos == len(new_rule.rhs):
+                            by_start.setdefault(i, []).append(state)
@@ -10,4 +10,53 @@ def is_nonterminal(symbol):
 def make_symbol(base_symbol, sfrom, sto):
     if sfrom is None and sto is None:
         return base_symbol
-    return base_symbol if is_terminal(base_symbol) else '[%s:%s-%s]' % (base_symbol[1:-1], sfrom, sto)
\ No newline at end of file
+    return base_symbol if is_terminal(base_symbol) else '[%s:%s-%s]' % (base_symbol[1:-1], sfrom, sto)
+
+
+class Vocabulary(object):
+    """Maps grammar symbols (terminals and nonterminals) to dense integer ids."""
+
+    def __init__(self, symbols=[]):
+        self._symbols = []
+        self._ids = dict()
+        # we check the brackets of a symbol once, when we intern it
+        self._is_terminal = []
+        for symbol in symbols:
+            self.add(symbol)
+
+    def add(self, symbol):
+        """intern a symbol and return its id"""
+        sym_id = self._ids.get(symbol, None)
+        if sym_id is None:
+            sym_id = len(self._symbols)
+            self._ids[symbol] = sym_id
+            self._symbols.append(symbol)
+            self._is_terminal.append(is_terminal(symbol))
+        return sym_id
+
+    def __len__(self):
+        return len(self._symbols)
+
+    def __contains__(self, symbol):
+        return symbol in self._ids
+
+    def __iter__(self):
+        """iterator over symbols in the order of their ids"""
+        return iter(self._symbols)
+
+    def __getitem__(self, symbol):
+        return self._ids[symbol]
+
+    def get(self, symbol, default=None):
+        """the id of a symbol (or `default` if we have never seen it)"""
+        return self._ids.get(symbol, default)
+
+    def symbol(self, sym_id):
+        """the symbol associated with an id"""
+        return self._symbols[sym_id]
+
+    def is_terminal(self, sym_id):
+        return self._is_terminal[sym_id]
+
+    def is_nonterminal(self, sym_id):
+        return not self._is_terminal[sym_id]
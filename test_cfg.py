@@ -0,0 +1,24 @@
+"""
+Tests for cfg.py (run with `python -m unittest test_cfg`).
+"""
+import unittest
+from cfg import WCFG
+from rule import Rule
+
+
+class OutgoingTest(unittest.TestCase):
+
+    def test_positions(self):
+        twice = Rule('[S]', ['[A]', '[A]'], 0.5)
+        once = Rule('[S]', ['[A]', 'a'], 0.5)
+        grammar = WCFG([twice, once])
+        self.assertEqual(list(grammar.outgoing('[A]')), [(twice, 0), (twice, 1), (once, 0)])
+        self.assertEqual(list(grammar.outgoing('a')), [(once, 1)])
+        self.assertEqual(list(grammar.outgoing('[S]')), [])
+        lexical = Rule('[A]', ['a'], 1.0)
+        grammar.add(lexical)  # the index follows the rules we add
+        self.assertEqual(list(grammar.outgoing('a')), [(once, 1), (lexical, 0)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,28 @@
+"""
+Tests for dense.py (run with `python -m unittest test_dense`).
+"""
+import importlib
+import unittest
+from cfg import WCFG, read_grammar_rules
+from parser import cky
+from dense import DenseGrammar, dense_inside
+
+inside = importlib.import_module('iniside-outside').inside
+
+
+class DenseInsideTest(unittest.TestCase):
+
+    def test_forest_nodes(self):
+        with open('examples/kallmeyer') as istream:
+            grammar = WCFG(read_grammar_rules(istream))
+        sentence = 'John saw the man with the telescope'.split()
+        forest = cky(grammar, sentence)
+        goal = forest.node('[S]', 0, len(sentence))
+        I = inside(forest, goal)
+        J = dense_inside(DenseGrammar(grammar), sentence, forest)
+        for node, weight in I.items():
+            self.assertAlmostEqual(weight, J[node], places=12)
+
+
+if __name__ == '__main__':
+    unittest.main()
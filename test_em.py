@@ -0,0 +1,67 @@
+"""
+Tests for the E-step of iniside-outside.py (run with `python -m unittest test_em`).
+"""
+import importlib
+import unittest
+import numpy as np
+from cfg import WCFG, read_grammar_rules
+from generate import Generator
+
+em = importlib.import_module('iniside-outside')
+
+
+def arithmetic():
+    with open('examples/arithmetic') as istream:
+        return WCFG(read_grammar_rules(istream))
+
+
+class UnparseableTest(unittest.TestCase):
+
+    corpus = [['a', '+', 'a'], ['a', '+'], ['a']]
+
+    def test_inside_outside(self):
+        with self.assertRaises(ValueError) as context:
+            em.inside_outside(self.corpus, arithmetic())
+        self.assertIn('a +', str(context.exception))
+
+    def test_parallel(self):
+        with self.assertRaises(ValueError):
+            em.inside_outside(self.corpus, arithmetic(), workers=2, shard_size=1)
+
+    def test_EM(self):
+        with self.assertRaises(ValueError):
+            em.EM(self.corpus, arithmetic(), 2)
+
+
+class LikelihoodTest(unittest.TestCase):
+
+    def test_with_likelihood(self):
+        grammar = arithmetic()
+        corpus = list(Generator(grammar, max_length=9, rng=np.random.RandomState(0)).stream(100, ('[E]',)))
+        f, loglik = em.inside_outside(corpus, grammar, shard_size=4, with_likelihood=True)
+        self.assertEqual(f.tolist(), em.inside_outside(corpus, grammar).tolist())
+        self.assertAlmostEqual(loglik, em.log_likelihood(corpus, grammar), places=9)
+
+
+class ParallelTest(unittest.TestCase):
+
+    def test_EM(self):
+        grammar = arithmetic()
+        corpus = list(Generator(grammar, max_length=9, rng=np.random.RandomState(0)).stream(200, ('[E]',)))
+        serial = em.EM(corpus, grammar, 3)
+        parallel = em.EM(corpus, grammar, 3, workers=3)
+        self.assertTrue(len(set(map(tuple, corpus))) > 16)  # more than one shard
+        self.assertEqual(serial.probs.tolist(), parallel.probs.tolist())
+
+    def test_stepwise_EM(self):
+        grammar = arithmetic()
+        stream = lambda: Generator(grammar, max_length=9, rng=np.random.RandomState(0)).stream(300, ('[E]',))
+        serial = list(em.stepwise_EM(stream(), grammar, batch_size=100))
+        parallel = list(em.stepwise_EM(stream(), grammar, batch_size=100, workers=3))
+        self.assertEqual(len(serial), 3)
+        for a, b in zip(serial, parallel):
+            self.assertEqual(a.probs.tolist(), b.probs.tolist())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,40 @@
+"""
+Tests for forest.py (run with `python -m unittest test_forest`).
+"""
+import unittest
+from forest import Forest
+from rule import Rule
+from symbol import Vocabulary
+
+
+def forest(edges):
+    """a forest over the spans 0-1 of the symbols in a list of (lhs, rhs) pairs"""
+    vocab = Vocabulary()
+    f = Forest(vocab)
+    for lhs, rhs in edges:
+        for sym in (lhs,) + rhs:
+            vocab.add(sym)
+        f.add(Rule(f.node(lhs, 0, 1), [f.node(sym, 0, 1) for sym in rhs], 1.0))
+    return f
+
+
+class TopologicalOrderTest(unittest.TestCase):
+
+    def test_children_first(self):
+        f = forest([('[S]', ('[A]', '[B]')), ('[A]', ('[B]',)), ('[B]', ('b',))])
+        order = f.topological_order(f.node('[S]', 0, 1))
+        position = dict((node, i) for i, node in enumerate(order))
+        for rule in f:
+            for child in rule.rhs:
+                self.assertTrue(position[child] < position[rule.lhs])
+
+    def test_cycle(self):
+        f = forest([('[S]', ('[A]',)), ('[A]', ('[S]',)), ('[A]', ('a',))])
+        with self.assertRaises(ValueError):
+            f.topological_order(f.node('[S]', 0, 1))
+        with self.assertRaises(ValueError):
+            f.topological_order()
+
+
+if __name__ == '__main__':
+    unittest.main()
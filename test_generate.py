@@ -0,0 +1,30 @@
+"""
+Tests for generate.py (run with `python -m unittest test_generate`).
+"""
+import unittest
+import numpy as np
+from cfg import WCFG, read_grammar_rules
+from generate import Generator
+
+
+def kallmeyer():
+    with open('examples/kallmeyer') as istream:
+        return WCFG(read_grammar_rules(istream))
+
+
+class GuardTest(unittest.TestCase):
+
+    def test_unsatisfiable(self):
+        generator = Generator(kallmeyer(), max_length=2, rng=np.random.RandomState(0), max_attempts=100)
+        with self.assertRaises(ValueError):
+            generator.sample(('[S]',))
+        self.assertEqual(generator.rejected, 100)
+
+    def test_satisfiable(self):
+        generator = Generator(kallmeyer(), max_length=4, rng=np.random.RandomState(0))
+        for sentence in generator.stream(20, ('[S]',)):
+            self.assertTrue(len(sentence) <= 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
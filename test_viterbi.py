@@ -0,0 +1,61 @@
+"""
+Tests for viterbi.py (run with `python -m unittest test_viterbi`).
+"""
+import math
+import unittest
+import numpy as np
+from cfg import WCFG
+from rule import Rule
+from parser import cky
+from viterbi import viterbi, best_first, kbest
+
+
+def random_grammar(rng, nonterminals=('[S]', '[A]', '[B]', '[C]'), terminals=('a', 'b')):
+    """a random PCFG in CNF where every nonterminal has every binary and lexical rule"""
+    rules = []
+    for X in nonterminals:
+        rhss = [(Y, Z) for Y in nonterminals for Z in nonterminals] + [(x,) for x in terminals]
+        for rhs, p in zip(rhss, rng.dirichlet([0.3] * len(rhss))):
+            rules.append(Rule(X, rhs, p))
+    return WCFG(rules)
+
+
+def logprob(derivation, prob):
+    return sum(math.log(prob(rule)) for rule in derivation)
+
+
+class BestFirstTest(unittest.TestCase):
+
+    def test_matches_viterbi(self):
+        rng = np.random.RandomState(0)
+        for _ in range(20):
+            grammar = random_grammar(rng)
+            for sentence in ('a', 'a b', 'a a b b b', 'b a a b a b'):
+                sentence = sentence.split()
+                forest = cky(grammar, sentence)
+                goal = forest.node('[S]', 0, len(sentence))
+                expected = logprob(viterbi(forest, goal), forest.prob)
+                for heuristic in (False, True):
+                    d = best_first(grammar, sentence, '[S]', heuristic)
+                    self.assertAlmostEqual(logprob(d, lambda rule: rule.prob), expected, places=9)
+
+
+class KBestTest(unittest.TestCase):
+
+    def test_deep_forest(self):
+        grammar = WCFG([Rule('[S]', ['a', '[S]'], 0.3), Rule('[S]', ['[S]', 'a'], 0.3), Rule('[S]', ['a'], 0.4)])
+        sentence = ['a'] * 300
+        forest = cky(grammar, sentence)
+        goal = forest.node('[S]', 0, len(sentence))
+        derivations = kbest(forest, goal, 10)
+        self.assertEqual(len(derivations), 10)
+        self.assertAlmostEqual(derivations[0][0], logprob(viterbi(forest, goal), forest.prob), places=9)
+        scores = [score for score, _ in derivations]
+        self.assertEqual(scores, sorted(scores, reverse=True))
+        for score, d in derivations:
+            self.assertAlmostEqual(score, logprob(d, forest.prob), places=9)
+        self.assertEqual(len(set(tuple(d) for _, d in derivations)), 10)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,275 @@
+"""
+Grammar transforms: from a WCFG with rules of any arity to one in Chomsky normal form.
+
+    prune          drops rules with zero probability and useless symbols (those that
+                   derive no string or cannot be reached from the start symbol)
+    binarize       splits long rules into binary ones and moves terminals out of rules
+                   with more than one RHS symbol
+    unary_closure  replaces chains of unary rules X -> Y by their total probability
+    to_cnf         all of the above, in this order (and prune again at the end)
+
+Each transform keeps the probability of every sentence (and, except for unary_closure,
+of every derivation), returns the new grammar in `grammar` and maps derivations of the new
+grammar back to derivations of the original one (see `map_back`).
+
+A derivation is a list of rules, top-down, whose symbols are formatted with their spans
+as in [S:0-5] (e.g. the rendered edges of viterbi or kbest, see Forest.render_rule), thus
+each nonterminal of a derivation is the LHS of exactly one of its rules.
+"""
+from collections import deque, OrderedDict
+import re
+import numpy as np
+from cfg import WCFG
+from rule import Rule
+from symbol import is_nonterminal, is_terminal
+
+_SPAN = re.compile(r'^\d+-\d+$')
+
+
+def _split(symbol):
+    """(grammar symbol, span) of a formatted symbol such as [S:0-5] (span is None for [S] or a terminal)"""
+    if is_terminal(symbol):
+        return symbol, None
+    base, sep, span = symbol[1:-1].rpartition(':')
+    if sep and _SPAN.match(span):
+        return '[%s]' % base, span
+    return symbol, None
+
+
+def _join(symbol, span):
+    return symbol if span is None else '[%s:%s]' % (symbol[1:-1], span)
+
+
+def _base(rule):
+    """a rule over grammar symbols (without spans)"""
+    return Rule(_split(rule.lhs)[0], [_split(sym)[0] for sym in rule.rhs], rule.prob)
+
+
+class Transform(object):
+    """A grammar obtained from `original`, with a map from its derivations to those of `original`."""
+
+    def __init__(self, original, grammar):
+        self.original = original
+        self.grammar = grammar
+
+    def map_back(self, derivation):
+        """
+        Map a derivation of `grammar` to a derivation of `original`.
+
+        :param derivation: a list of rules over formatted symbols (top-down)
+        :returns: a list of rules of the original grammar over formatted symbols (top-down),
+            with the probabilities of the original grammar
+        """
+        if not derivation:
+            return []
+        by_lhs = dict((rule.lhs, rule) for rule in derivation)
+        Q = deque([derivation[0].lhs])
+        d = []
+        while Q:
+            rules, children = self._expand(by_lhs[Q.popleft()], by_lhs)
+            d.extend(rules)
+            Q.extend(children)
+        return d
+
+    def _expand(self, rule, by_lhs):
+        """the original rules a rule stands for, and the nodes of the derivation below them"""
+        rule = Rule(rule.lhs, rule.rhs, self.original.prob(_base(rule)))
+        return [rule], [sym for sym in rule.rhs if is_nonterminal(sym)]
+
+
+class Composition(Transform):
+    """Transforms applied one after the other."""
+
+    def __init__(self, transforms):
+        Transform.__init__(self, transforms[0].original, transforms[-1].grammar)
+        self.transforms = transforms
+
+    def map_back(self, derivation):
+        for transform in reversed(self.transforms):
+            derivation = transform.map_back(derivation)
+        return derivation
+
+
+def prune(cfg, start):
+    """
+    Drop rules with zero probability and rules with a useless symbol: one that derives
+    no string (it is not generating) or that the start symbol never reaches.
+
+    Rules we keep keep their probabilities (a derivation never uses a rule we drop,
+    thus the probability of each sentence stays the same).
+
+    :returns: a Transform
+    """
+    rules = [rule for rule in cfg if cfg.prob(rule) > 0.0]
+    # generating symbols, to a fixpoint
+    generating = set()
+    changed = True
+    while changed:
+        changed = False
+        for rule in rules:
+            if rule.lhs not in generating and all(is_terminal(sym) or sym in generating for sym in rule.rhs):
+                generating.add(rule.lhs)
+                changed = True
+    rules = [rule for rule in rules if rule.lhs in generating and
+             all(is_terminal(sym) or sym in generating for sym in rule.rhs)]
+    # reachable symbols through the rules we kept
+    by_lhs = dict()
+    for rule in rules:
+        by_lhs.setdefault(rule.lhs, []).append(rule)
+    reachable = set([start])
+    Q = deque([start])
+    while Q:
+        for rule in by_lhs.get(Q.popleft(), ()):
+            for sym in rule.rhs:
+                if is_nonterminal(sym) and sym not in reachable:
+                    reachable.add(sym)
+                    Q.append(sym)
+    grammar = WCFG(Rule(rule.lhs, rule.rhs, cfg.prob(rule)) for rule in rules if rule.lhs in reachable)
+    return Transform(cfg, grammar)
+
+
+class Binarization(Transform):
+
+    def __init__(self, cfg):
+        """
+        Make every rule X -> Y Z, X -> Y or X -> x.
+
+        A terminal x in a longer rule is replaced by a new preterminal [@x] (with [@x] -> x),
+        and a rule X -> Y_1 ... Y_k (k > 2) by
+            X -> Y_1 [@Y_2|...|Y_k]    with the probability of the rule
+            [@Y_2|...|Y_k] -> Y_2 [@Y_3|...|Y_k]    with probability 1
+            ...
+        New symbols stand for a sequence of symbols, thus rules that end alike share them.
+        """
+        self._preterminals = dict()  # new preterminal -> its terminal
+        self._intermediates = set()
+        rules = OrderedDict()  # new rule -> probability (new rules are added once)
+        for rule in cfg:
+            if len(rule.rhs) == 0:
+                raise ValueError('I do not support rules with an empty RHS: %s' % rule)
+            rhs = list(rule.rhs)
+            if len(rhs) > 1:
+                rhs = [self._preterminal(sym, cfg, rules) if is_terminal(sym) else sym for sym in rhs]
+            lhs, p = rule.lhs, cfg.prob(rule)
+            while len(rhs) > 2:
+                rest = self._new_symbol('[@%s]' % '|'.join(rhs[1:]), cfg)
+                self._intermediates.add(rest)
+                rules[Rule(lhs, [rhs[0], rest], p)] = p
+                lhs, p, rhs = rest, 1.0, rhs[1:]
+            rules[Rule(lhs, rhs, p)] = p
+        Transform.__init__(self, cfg, WCFG(rules.keys()))
+
+    def _new_symbol(self, symbol, cfg):
+        if symbol in cfg.nonterminals:
+            raise ValueError('I cannot introduce %s: the grammar already has it' % symbol)
+        return symbol
+
+    def _preterminal(self, terminal, cfg, rules):
+        symbol = self._new_symbol('[@%s]' % terminal, cfg)
+        if symbol not in self._preterminals:
+            self._preterminals[symbol] = terminal
+            rules[Rule(symbol, [terminal], 1.0)] = 1.0
+        return symbol
+
+    def _flatten(self, symbol, by_lhs):
+        """the original RHS symbols a (formatted) symbol stands for"""
+        base, _ = _split(symbol)
+        if base in self._preterminals:
+            return [by_lhs[symbol].rhs[0]]
+        if base in self._intermediates:
+            return [sym for child in by_lhs[symbol].rhs for sym in self._flatten(child, by_lhs)]
+        return [symbol]
+
+    def _expand(self, rule, by_lhs):
+        rhs = list(rule.rhs) if len(rule.rhs) == 1 else [sym for child in rule.rhs for sym in self._flatten(child, by_lhs)]
+        return Transform._expand(self, Rule(rule.lhs, rhs, rule.prob), by_lhs)
+
+
+def binarize(cfg):
+    """split long rules and move terminals to preterminals (see Binarization), returns a Transform"""
+    return Binarization(cfg)
+
+
+class UnaryClosure(Transform):
+
+    def __init__(self, cfg):
+        """
+        Remove unary rules X -> Y (between nonterminals).
+
+        Let U[X, Y] be the probability of the rule X -> Y. The total probability of all chains
+        X =>* Y of unary rules (including the empty one) is
+            U*[X, Y] = sum_n U^n [X, Y] = (I - U)^-1 [X, Y]
+        which also sums up unary cycles. Every other rule Y -> beta gives X -> beta, with
+        probability sum_Y U*[X, Y] p(Y -> beta).
+
+        A derivation of the closed grammar stands for many derivations of the original one
+        (one per chain), `map_back` restores the most probable chain.
+        """
+        nonterminals = sorted(cfg.nonterminals)
+        index = dict((sym, i) for i, sym in enumerate(nonterminals))
+        n = len(nonterminals)
+        U = np.zeros((n, n))
+        unary = dict()  # (X, Y) -> the rule X -> Y
+        for rule in cfg:
+            if len(rule.rhs) == 1 and is_nonterminal(rule.rhs[0]):
+                U[index[rule.lhs], index[rule.rhs[0]]] += cfg.prob(rule)
+                unary[rule.lhs, rule.rhs[0]] = rule
+        closure = np.linalg.inv(np.eye(n) - U)
+        if (closure < -1e-12).any():
+            raise ValueError('I cannot sum up the unary rules: their chains diverge')
+        self.nonterminals = nonterminals
+        self.closure = closure
+        # best[X, Y] is the probability of the most probable chain X =>* Y and after[X, Y] the symbol after X in it
+        best = np.eye(n)
+        after = np.tile(np.arange(n), (n, 1))
+        best = np.maximum(best, U)
+        for k in range(n):
+            through = best[:, k, None] * best[None, k, :]
+            better = through > best
+            best = np.where(better, through, best)
+            after = np.where(better, after[:, k, None], after)
+        self._chains = dict()  # closed rule -> the original rules it stands for (most probable chain first)
+        rules = OrderedDict()  # closed rule -> its probability
+        chain_probs = dict()  # closed rule -> the probability of _chains[closed rule]
+        for rule in cfg:
+            if len(rule.rhs) == 1 and is_nonterminal(rule.rhs[0]):
+                continue
+            y, p = index[rule.lhs], cfg.prob(rule)
+            for x in np.flatnonzero(best[:, y] > 0.0).tolist():
+                closed = Rule(nonterminals[x], rule.rhs, 0.0)
+                rules[closed] = rules.get(closed, 0.0) + closure[x, y] * p
+                if best[x, y] * p > chain_probs.get(closed, -1.0):
+                    chain_probs[closed] = best[x, y] * p
+                    chain = []
+                    while x != y:
+                        z = after[x, y]
+                        chain.append(unary[nonterminals[x], nonterminals[z]])
+                        x = z
+                    self._chains[closed] = chain + [rule]
+        Transform.__init__(self, cfg, WCFG(Rule(rule.lhs, rule.rhs, p) for rule, p in rules.items()))
+
+    def _expand(self, rule, by_lhs):
+        chain = self._chains[_base(rule)]
+        _, span = _split(rule.lhs)
+        original = self.original
+        d = [Rule(_join(r.lhs, span), [_join(r.rhs[0], span)], original.prob(r)) for r in chain[:-1]]
+        d.append(Rule(_join(chain[-1].lhs, span), rule.rhs, original.prob(chain[-1])))
+        return d, [sym for sym in rule.rhs if is_nonterminal(sym)]
+
+
+def unary_closure(cfg):
+    """remove unary rules, summing up their chains (see UnaryClosure), returns a Transform"""
+    return UnaryClosure(cfg)
+
+
+def to_cnf(cfg, start):
+    """
+    Prune, binarize and close a grammar under unary rules, then prune what the closure made unreachable.
+
+    :returns: a Transform whose grammar is in CNF (rules X -> Y Z and X -> x)
+    """
+    transforms = [prune(cfg, start)]
+    transforms.append(binarize(transforms[-1].grammar))
+    transforms.append(unary_closure(transforms[-1].grammar))
+    transforms.append(prune(transforms[-1].grammar, start))
+    return Composition(transforms)
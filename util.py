@@ -2,6 +2,7 @@ import numpy as np
 from nltk import Tree
 from collections import defaultdict
 from cfg import WCFG, read_grammar_rules
+from corpus import WeightedCorpus
 
 
 def make_nltk_tree(derivation):
@@ -14,13 +15,15 @@ def make_nltk_tree(derivation):
 	return make_tree(derivation[0].lhs)
 
 def checking_number_parses(n=100):
-	number = list()
-	for sentence in toy_corpus[0:n]:
+	# repeated sentences are parsed once
+	corpus = WeightedCorpus(toy_corpus[0:n])
+	parses = dict()
+	for sentence, count in corpus:
 		toy_forest = cky(toy_grammar, sentence)
-		toy_goal = make_symbol('[S]', 0, len(sentence))
+		toy_goal = toy_forest.node('[S]', 0, len(sentence))
 		N_toy = counting(toy_forest, toy_goal)
-		number.append(N_toy[toy_goal])
-	return number
+		parses[sentence] = N_toy[toy_goal]
+	return [parses[tuple(sentence)] for sentence in toy_corpus[0:n]]
 
 G = WCFG(read_grammar_rules(open('examples/ambiguous', 'r')))
 
@@ -33,8 +36,8 @@ def get_rules_by_rhs(grammar, symbol):
 	:returns: list of all rules in grammar with symbol in rhs 
 	"""
 	rules = []
-	for rule in grammar:
-		if symbol in rule.rhs:
+	for rule, position in grammar.outgoing(symbol):
+		if not rules or rules[-1] is not rule:  # a rule may have the symbol in more than one position
 			rules.append(rule)
 	return rules
 
@@ -51,22 +54,20 @@ def get_instances(rule, forest):
 	[A:i-j] -> [B:i-k] [C:k-j] 
 	
 	from the forest and returns them in a list.
+
+	:param rule: a rule of the grammar (over str symbols)
+	:param forest: a Forest parsed with that grammar
 	"""
+	vocab = forest.vocab
+	if rule.lhs not in vocab or not all(sym in vocab for sym in rule.rhs):
+		return []
+	lhs = vocab[rule.lhs]
+	rhs = tuple(vocab[sym] for sym in rule.rhs)
 	instances = []
 	for r in forest:
-		if r.lhs[1] == rule.lhs[1] and len(r.rhs)==len(rule.rhs):
-			test = []
-			for i in range(len(r.rhs)):
-				try:
-					# if for example r.rhs[i] = '[A]' 
-					v = r.rhs[i][1] == rule.rhs[i][1]
-					test.append(v)
-				except IndexError:
-					# if for example r.rhs[i] = '*' 
-					v = r.rhs[i][0] == rule.rhs[i][0]
-					test.append(v)
-			if np.all(test):
-				instances.append(r)
+		# nodes are triples (sym_id, start, end), we compare their symbol ids
+		if forest.triple(r.lhs)[0] == lhs and tuple(forest.triple(s)[0] for s in r.rhs) == rhs:
+			instances.append(r)
 	return instances
 
 def difference_grammar(one, another):
@@ -77,13 +78,6 @@ def difference_grammar(one, another):
 	:param another: another WCFG (same rules as one!)
 	:returns: a WCFG with the difference in rule prob between one and another
 	"""
-	diff_grammar = WCFG()
-	for rule in one:
-		for r in another:
-			if r.rhs == rule.rhs and r.lhs == rule.lhs:
-				approx_prob = r.prob
-				break
-		diff_grammar.add(Rule(rule.lhs, rule.rhs, abs(rule.prob-approx_prob)))
-	return diff_grammar
+	return one.reweight([abs(one.prob(rule) - another.prob(rule)) for rule in one])
 
 
@@ -1,54 +1,359 @@
-from collections import deque
-from symbol import is_nonterminal
+from collections import deque, defaultdict
+import heapq
+import weakref
+import numpy as np
+from semiring import LogViterbi, Counting, inside_values, edge_weights
+from agenda import PriorityAgenda
+from parser import cky_axioms, intern_sentence
+from rule import Rule
+from symbol import make_symbol
 
-def viterbi(forest, I, start):
+def viterbi(forest, start):
+    """
+    The best derivation of a forest.
+
+    Edges are selected by the max-plus (LogViterbi) semiring, i.e. by the log-probability
+    of the best derivation under them (not by their inside weight).
+
+    :param forest: a Forest
+    :param start: the start symbol (a node of the forest)
+    :returns: a list of edges (top-down), empty if start has no derivation
+    """
+    values, back = inside_values(forest, LogViterbi, start)
+    if back[start] is None:
+        return []
     Q = deque([start])
     d = []
     while Q:
         parent = Q.popleft()
-        incoming = forest.get(parent)
-        # here we will find the distribution over edges
-        weights = [0.0] * len(incoming)
-        for i, rule in enumerate(incoming):
-            weights[i] = rule.prob
-            for child in rule.rhs:
-                weights[i] *= I[child]
-        # here we select the edge that is the maximum of this distribution
-        weight, selected = max(zip(weights, incoming))
+        selected = forest.rule(back[parent])
         # we also need to queue the nonterminals in the tail of the edge
         for sym in selected.rhs:
-            if is_nonterminal(sym):
+            if forest.is_nonterminal(sym):
                 Q.append(sym)
         # and finally, add the selected edge to the derivation
         d.append(selected)
     return d
 
+def kbest(forest, start, k):
+    """
+    The k best derivations of a forest, best first (Huang and Chiang, 2005, algorithm 3).
+
+    A derivation of a node is an incoming edge e together with a vector j that says which
+    derivation (the 1st, 2nd, ...) of each child of e we use. Each node keeps the derivations
+    we found so far (in order) and a heap of candidates. The successors of a derivation (e, j)
+    are (e, j + b_i), one for each child i, and we ask the children for their (j_i + 2)-th
+    derivation only when such a successor is needed. Thus we visit each edge once, to find
+    the 1-best, and then spend about k log k to find the rest.
+
+    :param forest: a Forest
+    :param start: the start symbol (a node of the forest)
+    :param k: how many derivations
+    :returns: a list of at most k pairs (log-probability, derivation) where a derivation is a
+        list of edges (top-down, as returned by `viterbi`)
+    """
+    weights = edge_weights(forest, LogViterbi)
+    best, _ = inside_values(forest, LogViterbi, start)
+    found = dict()  # node -> [(score, edge, j)] in order (an edge of None for terminals)
+    candidates = dict()  # node -> heap of (-score, edge, j)
+    queued = dict()  # node -> set of (edge, j) ever queued
+    extended = dict()  # node -> how many of its derivations have had their successors queued
+
+    # bottom-up, the best derivation under each incoming edge (from the inside pass) and the 1-best
+    for node in forest.topological_order(start):
+        if forest.is_terminal(node):
+            found[node] = [(0.0, None, ())]
+            candidates[node] = []
+            extended[node] = 1
+            continue
+        heap = []
+        for edge in forest.incoming_edges(node):
+            total = weights[edge] + sum(best[child] for child in forest.rule(edge).rhs)
+            if total != LogViterbi.zero:
+                heap.append((-total, edge, (0,) * len(forest.rule(edge).rhs)))
+        heapq.heapify(heap)
+        candidates[node] = heap
+        queued[node] = set((edge, j) for _, edge, j in heap)
+        found[node] = []
+        extended[node] = 0
+        if heap:
+            negative, edge, j = heapq.heappop(heap)
+            found[node].append((-negative, edge, j))
+
+    def exhausted(node):
+        return extended[node] == len(found[node]) and not candidates[node]
+
+    def score(edge, j):
+        total = weights[edge]
+        for child, i in zip(forest.rule(edge).rhs, j):
+            total += found[child][i][0]
+        return total
+
+    # the kk best derivations of a node are found on demand: to extend the last derivation (e, j) of
+    # a node we need the (j_i + 2)-th derivation of each child i, thus we keep a stack of requests
+    # (node, kk) instead of recursing (derivations may be as deep as the sentence is long)
+    stack = [(start, k)] if start in found else []
+    while stack:
+        node, kk = stack[-1]
+        derivations = found[node]
+        if len(derivations) >= kk or exhausted(node):
+            stack.pop()
+            continue
+        if extended[node] < len(derivations):
+            _, edge, j = derivations[-1]
+            children = forest.rule(edge).rhs
+            pending = [(child, i + 2) for child, i in zip(children, j)
+                       if len(found[child]) < i + 2 and not exhausted(child)]
+            if pending:
+                stack.extend(pending)
+                continue
+            # the successors (e, j + b_i) whose child derivations exist
+            for i, child in enumerate(children):
+                successor = j[:i] + (j[i] + 1,) + j[i + 1:]
+                if successor[i] < len(found[child]) and (edge, successor) not in queued[node]:
+                    queued[node].add((edge, successor))
+                    heapq.heappush(candidates[node], (-score(edge, successor), edge, successor))
+            extended[node] = len(derivations)
+        if candidates[node]:
+            negative, edge, j = heapq.heappop(candidates[node])
+            derivations.append((-negative, edge, j))
+
+    derivations = []
+    for total, edge, j in found.get(start, [])[:k]:
+        d = []
+        Q = deque([(edge, j)])
+        while Q:
+            edge, j = Q.popleft()
+            d.append(forest.rule(edge))
+            for child, i in zip(forest.rule(edge).rhs, j):
+                if not forest.is_terminal(child):
+                    Q.append(found[child][i][1:])
+        derivations.append((total, d))
+    return derivations
+
 def counting(forest, start):  # acyclic hypergraph
-    N = dict()
-    
-    def get_count(symbol):
-        w = N.get(symbol, None)
-        if w is not None:
-            return w
-        incoming = forest.get(symbol, set())
-        if len(incoming) == 0:  # terminals have already been handled, this must be a nonterminal dead end
-            N[symbol] = w
-            return 0
-        w = 0
-        for rule in incoming:
-            k = 1
-            for child in rule.rhs:
-                k *= get_count(child)
-            w += k
-        N[symbol] = w
-        return w
-    
+    """
+    Count derivations bottom-up, in the topological order of the forest.
+
+    :param forest: a Forest
+    :param start: the start symbol (a node of the forest)
+    :returns: a dictionary mapping a symbol (terminal or nonterminal) to its number of derivations
+    """
+    values, _ = inside_values(forest, Counting, start)
+    N = dict((node, values[node]) for node in forest.topological_order(start))
     # handles terminals
     for sym in forest.terminals:
         N[sym] = 1
-    # handles nonterminals
-    #for sym in forest.nonterminals:
-    #    get_inside(sym)
-    get_count(start)
-        
     return N
+
+def _max_convolution(f, g):
+    """h[m] = max over a + b = m of f[a] g[b], for m up to the length of f and g"""
+    N = len(f)
+    h = np.zeros(N)
+    for a in np.flatnonzero(f).tolist():
+        np.maximum(h[a:], f[a] * g[:N - a], out=h[a:])
+    return h
+
+def span_heuristics(cfg, start, n):
+    """
+    Admissible estimates of Viterbi outside weights, computed from the grammar and the length of
+    the sentence alone (the SX estimate of Klein and Manning, 2003).
+
+    We bound the weight of a context by the number of words on either side of a span, rather
+    than by which words they are:
+        inside[X][m]: the best derivation of X over any m words
+        suffix[rule][k][m]: the best derivation of rule.rhs[k:] over any m words
+        outside[X][l, r]: the best context of X in a derivation of start over l + r words other
+            than those of X, l to its left and r to its right, i.e. the max over rules
+            Y -> alpha X beta of outside[Y][l - a, r - b] p(Y -> alpha X beta) inside(alpha)[a] inside(beta)[b]
+    Thus the Viterbi outside weight of an item [X -> alpha * beta, i, j] in a sentence of length n
+    is at most the max over m of suffix[X -> alpha beta][len(alpha)][m] outside[X][i, n - j - m].
+
+    :param cfg: a WCFG (an InternedWCFG if start is a symbol id)
+    :param start: the start symbol
+    :param n: the length of the sentence
+    :returns: (inside, outside, suffix) dictionaries of vectors (of length n + 1) and matrices
+        (of shape (n + 1, n + 1)), outside and inside by nonterminal, suffix by rule
+    """
+    probs = cfg.probs
+    N = n + 1
+    empty = np.zeros(N)  # the empty string
+    empty[0] = 1.0
+    word = np.zeros(N)  # a terminal
+    word[1] = 1.0
+    inside = dict((X, np.zeros(N)) for X in cfg.nonterminals)
+
+    def weights(sym):
+        return word if cfg.is_terminal(sym) else inside[sym]
+
+    # both are fixed points of a max-times recursion, which only improves until it converges;
+    # we revisit a rule only when a symbol of its RHS improved
+    rule_ids = range(len(cfg))
+    while rule_ids:
+        changed = set()
+        for rule_id in rule_ids:
+            rule = cfg.rule(rule_id)
+            w = empty * probs[rule_id]
+            for sym in rule.rhs:
+                w = _max_convolution(w, weights(sym))
+            if (w > inside[rule.lhs]).any():
+                np.maximum(inside[rule.lhs], w, out=inside[rule.lhs])
+                changed.add(rule.lhs)
+        rule_ids = sorted(set(cfg.rule_id(rule) for sym in changed for rule, _ in cfg.outgoing(sym)))
+    suffix = dict()
+    prefix = dict()
+    for rule in cfg:
+        products = [empty]
+        for sym in reversed(rule.rhs):
+            products.append(_max_convolution(weights(sym), products[-1]))
+        suffix[rule] = products[::-1]
+        products = [empty]
+        for sym in rule.rhs:
+            products.append(_max_convolution(products[-1], weights(sym)))
+        prefix[rule] = products
+    outside = dict((X, np.zeros((N, N))) for X in cfg.nonterminals)
+    outside[start][0, 0] = 1.0
+    improved = set([start])
+    while improved:
+        changed = set()
+        for Y in improved:
+            for rule in cfg.get(Y):
+                p = probs[cfg.rule_id(rule)]
+                for k, X in enumerate(rule.rhs):
+                    if cfg.is_terminal(X):
+                        continue
+                    # X has a words of the rule to its left and b to its right
+                    left, right = prefix[rule][k], suffix[rule][k + 1]
+                    for a in np.flatnonzero(left).tolist():
+                        for b in np.flatnonzero(right).tolist():
+                            w = outside[Y][:N - a, :N - b] * (p * left[a] * right[b])
+                            target = outside[X][a:, b:]
+                            if (w > target).any():
+                                np.maximum(target, w, out=target)
+                                changed.add(X)
+        improved = changed
+    return inside, outside, suffix
+
+# interned grammar -> (probabilities, {(start, n): tables}), see _heuristic_tables
+_heuristic_cache = weakref.WeakKeyDictionary()
+
+def _heuristic_tables(icfg, start, n):
+    """
+    The tables of span_heuristics as lists, computed once per grammar, start symbol and length
+    (and again if the probabilities of the grammar change).
+
+    :returns: (suffix, outside) where suffix[rule_id][k] is a list over m, and outside[X][l] a list over r
+    """
+    probs = icfg.probs
+    cached = _heuristic_cache.get(icfg, None)
+    if cached is None or not np.array_equal(cached[0], probs):
+        cached = (probs.copy(), dict())
+        _heuristic_cache[icfg] = cached
+    tables = cached[1].get((start, n), None)
+    if tables is None:
+        _, outside, suffix = span_heuristics(icfg, start, n)
+        tables = ([[w.tolist() for w in suffix[icfg.rule(rule_id)]] for rule_id in range(len(icfg))],
+                  dict((X, w.tolist()) for X, w in outside.items()))
+        cached[1][(start, n)] = tables
+    return tables
+
+def best_first(cfg, sentence, start, heuristic=True, agenda=None):
+    """
+    Viterbi parsing with Knuth's algorithm, or A* with an outside heuristic, without building a forest.
+
+    Items are popped best first, thus the first time the goal item [S -> gamma *, 0, n] is
+    popped, we hold the best derivation and we stop. With the heuristic, the priority of an
+    item [X -> alpha * beta, i, j] is its score times
+        max over m of suffix[X -> alpha beta][len(alpha)][m] outside[X][i, n - j - m]
+    (see span_heuristics), which is admissible and consistent: the derivation is still the best.
+    The estimates depend on the grammar and the length of the sentence alone, thus we compute
+    them once per grammar and length (see _heuristic_tables).
+
+    An item is a tuple (rule id, pos, start, dot) rather than an Item: we try many more
+    derivations than we queue (one per pair of adjacent items), and a tuple of integers hashes
+    and compares without calling back into Python. We index the items we pop, with their
+    final scores, ourselves.
+
+    A* beats building the whole forest with `cky` and `viterbi` when the estimates prune much
+    of the chart, which they do less as sentences grow: for a grammar where every nonterminal
+    combines with every other, A* pops a tenth to a half of CKY's items for sentences of 9 words
+    and is about twice as fast, but for 25 words, though it pops a fifth of them, it tries many
+    derivations per popped item and merely matches CKY. The tables take O(n^3) steps per rule,
+    paid by the first sentence of each length.
+
+    :param cfg: a WCFG
+    :param sentence: the input sentence (as a list or tuple)
+    :param start: the start symbol (str)
+    :param heuristic: whether to use A* (otherwise items are prioritised by their score alone)
+    :param agenda: an empty PriorityAgenda (by default a new one)
+    :returns: a list of rules (top-down) whose symbols are formatted as in a forest (e.g. [S:0-5]),
+        and whose probability is that of the grammar rule, empty if the sentence has no derivation
+    """
+    icfg = cfg.interned()
+    vocab = cfg.vocab
+    words = intern_sentence(cfg, sentence)
+    goal = vocab[start]
+    n = len(sentence)
+    A = PriorityAgenda() if agenda is None else agenda
+    rules = [icfg.rule(rule_id) for rule_id in range(len(icfg))]
+    if heuristic:
+        suffix, outside = _heuristic_tables(icfg, goal, n)
+
+        def estimate(item):
+            rule_id, pos, i, j = item
+            inner, outer, r = suffix[rule_id][pos], outside[rules[rule_id].lhs][i], n - j
+            return max(inner[m] * outer[r - m] for m in range(r + 1))
+    else:
+        estimate = None
+
+    # popped items with their (final) scores: incomplete ones by the symbol they wait for
+    # and their dot, complete ones by their LHS and start
+    waiting = defaultdict(list)
+    complete = defaultdict(list)
+    push = A.push
+    for item in cky_axioms(icfg, words):
+        rule_id = icfg.rule_id(item.rule)
+        push((rule_id, 0, item.start, item.start), icfg.prob(item.rule), None, estimate)
+    found = None
+    while A:
+        item = A.pop()
+        rule_id, pos, i, j = item
+        rule = rules[rule_id]
+        score = A.score(item)
+        if pos == len(rule.rhs):
+            if rule.lhs == goal and i == 0 and j == n:
+                found = item
+                break
+            # advance items waiting for rule.lhs
+            for incomplete, incomplete_score in waiting.get((rule.lhs, i), ()):
+                push((incomplete[0], incomplete[1] + 1, incomplete[2], j), incomplete_score * score,
+                     (incomplete, item), estimate)
+            complete[rule.lhs, i].append((item, score))
+        elif icfg.is_nonterminal(rule.rhs[pos]):
+            for other, other_score in complete.get((rule.rhs[pos], j), ()):
+                push((rule_id, pos + 1, i, other[3]), score * other_score, (item, other), estimate)
+            waiting[rule.rhs[pos], j].append((item, score))
+        elif j < n and words[j] == rule.rhs[pos]:  # scan
+            push((rule_id, pos + 1, i, j + 1), score, (item, None), estimate)
+    if found is None:
+        return []
+    d = []
+    Q = deque([found])
+    while Q:
+        item = Q.popleft()
+        rule = rules[item[0]]
+        # walk the back-pointers from the complete item to the axiom, collecting its children
+        children = []
+        complete_children = []
+        current = item
+        while current[1] > 0:
+            previous, child = A.best_back(current)
+            children.append((rule.rhs[current[1] - 1], previous[3], current[3]))
+            if child is not None:
+                complete_children.append(child)
+            current = previous
+        children.reverse()
+        Q.extend(reversed(complete_children))
+        rhs = [make_symbol(vocab.symbol(sym), i, j) for sym, i, j in children]
+        d.append(Rule(make_symbol(vocab.symbol(rule.lhs), item[2], item[3]), rhs, icfg.prob(rule)))
+    return d